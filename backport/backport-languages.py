@@ -1,37 +1,65 @@
 """
 Put this file in a master checkout under .github/.
-It should be next to backport.py.
+It should be next to backport.py and git_session.py.
+
+By default the languages are backported by filtering the output of
+"git diff" and applying that with "git apply". With --objects, the language
+files are instead read straight from the git objects, merged string by string,
+and written out; this doesn't depend on the context of the diff applying.
+
+To backport into several release branches at once, give them with --release
+(more than once). The checkout is left alone: the languages of upstream/master
+are merged into every release like with --objects, and committed on top of it
+to the branch "release-languages-<release>" (for upstream/release/14 that is
+"release-languages-14"). Every language of master is read and parsed once,
+for all releases together, and the languages are merged in parallel.
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import difflib
 import glob
-import subprocess
-import shlex
+import hashlib
+import itertools
+import os
+import shutil
 import sys
+import tempfile
 
+import git_session
 
-def backport_language(language_file, blacklisted_ids, diff_to_stdout=False):
-    if sys.platform == "win32":
-        # shlex.split doesn't handle backslash properly
-        language_file = language_file.replace("\\", "/")
 
-    result = subprocess.run(
-        shlex.split("git diff HEAD..upstream/master -- %s" % language_file), check=True, stdout=subprocess.PIPE
-    )
+def filter_language_diff(lines, blacklisted_ids):
+    # Yields the diff of a single language file without the modifications to
+    # blacklisted ids, or nothing if nothing is left to apply. Only a chunk at
+    # a time is held, so this can be written out while the diff is read.
+    held = []
+    for line in _filter_language_chunks(lines, blacklisted_ids):
+        if held is None:
+            yield line
+            continue
+
+        held.append(line)
+        # Fewer lines than this means no chunks were found, so nothing to do
+        if len(held) >= 6:
+            yield from held
+            held = None
 
-    input_lines = []
+
+def _filter_language_chunks(lines, blacklisted_ids):
     chunk = []
     # We start with this set to True, to pick up any headers before the
     # patch really begins
     chunk_has_modification = True
 
-    # Decode the result, skip the 4 line header
-    for line in result.stdout.decode().split("\n"):
+    for line in lines:
         if not line or line.startswith("@@") or line.startswith(("---", "+++")):
             # Only add the chunk if there was a modification to it.
             # 'git apply' cannot handle chunks with no modifications.
             if chunk_has_modification:
-                input_lines.extend(chunk)
+                yield from chunk
             chunk = []
             chunk_has_modification = False
 
@@ -39,7 +67,7 @@ def backport_language(language_file, blacklisted_ids, diff_to_stdout=False):
             if line.startswith("@@"):
                 chunk.append(line)
             else:
-                input_lines.append(line)
+                yield line
             continue
 
         # Passthrough all the unmodified lines (they are just context)
@@ -60,29 +88,503 @@ def backport_language(language_file, blacklisted_ids, diff_to_stdout=False):
         else:
             chunk.append(" " + line[1:])
 
-    # No chunks found, so nothing to do
-    if len(input_lines) < 6:
+
+# Filtered diffs of earlier runs, one file per combination of blobs and
+# blacklist they were made from.
+LANGUAGE_CACHE = ".backport-languages-cache"
+
+# The blacklist, set once in every worker process rather than sent along with
+# every language.
+_blacklisted_ids = None
+
+
+def _init_worker(blacklisted_ids):
+    global _blacklisted_ids
+    _blacklisted_ids = blacklisted_ids
+
+
+def _filter_language(item):
+    filename, lines = item
+    try:
+        return filename, list(filter_language_diff(lines, _blacklisted_ids)), None
+    except Exception as e:
+        return filename, None, f"{type(e).__name__}: {e}"
+
+
+def diff_lines(paths):
+    # Yield the lines of "git diff HEAD..upstream/master" for the given paths
+    # while git produces them, instead of reading the whole diff first.
+    return git_session.stream(["diff", "HEAD..upstream/master", "--"] + paths)
+
+
+def split_diff(lines_in):
+    # Split a multi-file diff, as it is read, into (filename, lines) per file;
+    # lines are read from the diff as they are used, so they have to be used
+    # before going to the next file.
+    # Every file ends with an empty line, like the output of a single-file diff.
+    current = None
+
+    def filename_of(line):
+        nonlocal current
+        if line.startswith("diff --git "):
+            current = line.split(" b/", 1)[1]
+        return current
+
+    for filename, lines in itertools.groupby(lines_in, filename_of):
+        if filename is not None:
+            yield filename, itertools.chain(lines, [""])
+
+
+def blob_oids(revision, path="src/lang"):
+    # Returns a dict of path -> blob hash of all language files in revision.
+    oids = {}
+    for entry in git_session.read_tree(f"{revision}:{path}") or []:
+        if entry.mode == "40000":
+            oids.update(blob_oids(revision, f"{path}/{entry.name}"))
+        else:
+            oids[f"{path}/{entry.name}"] = entry.oid
+    return oids
+
+
+def prepare_language_cache():
+    # Earlier versions kept the whole cache in a single JSON file.
+    if os.path.isfile(LANGUAGE_CACHE):
+        os.unlink(LANGUAGE_CACHE)
+    os.makedirs(LANGUAGE_CACHE, exist_ok=True)
+
+
+class PatchOutput:
+    # Where the filtered diffs are written: stdout, or the input of a
+    # "git apply" that is started for the first write (it refuses to apply
+    # nothing). Once aborted, nothing is written anymore, and nothing is
+    # applied; what was already shown on stdout stays there.
+    def __init__(self, exit_stack, diff_to_stdout):
+        self.exit_stack = exit_stack
+        self.diff_to_stdout = diff_to_stdout
+        self.feed = None
+        self.aborted = False
+
+    def write(self, text):
+        if self.aborted:
+            return
+        if self.diff_to_stdout:
+            sys.stdout.write(text)
+            return
+        if self.feed is None:
+            self.feed = self.exit_stack.enter_context(git_session.feed(["apply", "--recount"]))
+        self.feed.write(text.encode())
+
+    def abort(self):
+        self.aborted = True
+        if self.feed is not None:
+            self.feed.abort()
+
+
+def write_language(lines, output, cache_file):
+    # Writes the filtered diff of a language to output while it is filtered,
+    # and to cache_file (unless None), which is only kept when it is complete.
+    # Returns an error when filtering failed, or None.
+    fp = open(cache_file + ".tmp", "w") if cache_file is not None else None
+    error = None
+    separator = ""
+    lines = iter(lines)
+    try:
+        while True:
+            try:
+                line = next(lines)
+            except StopIteration:
+                break
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                break
+
+            output.write(separator + line)
+            if fp is not None:
+                fp.write(separator + line)
+            separator = "\n"
+    finally:
+        if fp is not None:
+            fp.close()
+
+    if fp is not None:
+        if error is None:
+            os.replace(cache_file + ".tmp", cache_file)
+        else:
+            os.unlink(cache_file + ".tmp")
+    return error
+
+
+def backport_languages(language_files, blacklisted_ids, diff_to_stdout=False, jobs=1, use_cache=True):
+    # Returns a list of (language file, error) for languages that failed; in
+    # that case nothing is applied.
+    if sys.platform == "win32":
+        # git always reports paths with forward slashes
+        language_files = [language_file.replace("\\", "/") for language_file in language_files]
+
+    # The filtered diff of a language only depends on both versions of the
+    # file and on the blacklist. Languages for which that combination was
+    # seen before are not diffed again; their filtered diff is read from the
+    # cache file named after it. An empty file means "nothing to do".
+    release_oids = blob_oids("HEAD")
+    master_oids = blob_oids("upstream/master")
+    blacklist_hash = hashlib.sha1("\n".join(sorted(blacklisted_ids)).encode()).hexdigest()
+
+    if use_cache:
+        prepare_language_cache()
+    keys = {}
+    cached = []
+    todo = []
+    for language_file in language_files:
+        if release_oids.get(language_file) == master_oids.get(language_file):
+            continue
+
+        key = f"{release_oids.get(language_file)}:{master_oids.get(language_file)}:{blacklist_hash}"
+        keys[language_file] = hashlib.sha1(key.encode()).hexdigest()
+        if use_cache and os.path.exists(os.path.join(LANGUAGE_CACHE, keys[language_file])):
+            cached.append(language_file)
+        else:
+            todo.append(language_file)
+
+    if cached:
+        print("%d languages unchanged since the last run" % len(cached))
+
+    # Every filtered diff goes to the output as soon as it is known, in the
+    # order of the paths (which is also the order of git's diff), so memory
+    # use doesn't grow with the amount of languages.
+    cached = collections.deque(sorted(cached))
+    errors = []
+    with contextlib.ExitStack() as exit_stack:
+        output = PatchOutput(exit_stack, diff_to_stdout)
+
+        def write_cached(until=None):
+            while cached and (until is None or cached[0] < until):
+                with open(os.path.join(LANGUAGE_CACHE, keys[cached.popleft()]), "r") as fp:
+                    shutil.copyfileobj(fp, output)
+
+        for filename, lines, error in filter_languages(todo, blacklisted_ids, jobs):
+            print("Backporting %s ..." % filename[len("src/lang/") :])
+            write_cached(filename)
+            if error is None:
+                cache_file = os.path.join(LANGUAGE_CACHE, keys[filename]) if use_cache else None
+                error = write_language(lines, output, cache_file)
+            if error is not None:
+                errors.append((filename, error))
+                output.abort()
+        write_cached()
+
+    # Only keep what was used this run, so the cache doesn't keep growing.
+    if use_cache:
+        used = set(keys.values())
+        for name in os.listdir(LANGUAGE_CACHE):
+            if name not in used:
+                os.unlink(os.path.join(LANGUAGE_CACHE, name))
+
+    return errors
+
+
+def filter_languages(language_files, blacklisted_ids, jobs):
+    # Yields (language file, filtered diff lines, error) for the languages
+    # that differ, in diff order. The lines have to be used before the next
+    # language.
+    if not language_files:
+        # "git diff" without paths would diff everything.
         return
 
-    total_input = "\n".join(input_lines)
-    if diff_to_stdout:
-        print(total_input)
+    # A single diff for all languages, rather than one per language.
+    languages = split_diff(diff_lines(language_files))
+
+    # Filtering is pure Python; spread the languages over multiple processes.
+    # Every language is then read whole, to send it to a worker. The results
+    # are collected in diff order, so the output is the same for any amount
+    # of jobs.
+    if jobs > 1:
+        languages = ((filename, list(lines)) for filename, lines in languages)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(blacklisted_ids,)
+        ) as executor:
+            yield from _ordered_map(executor, _filter_language, languages, jobs * 2)
         return
 
-    result = subprocess.run(shlex.split("git apply --recount"), check=True, input=total_input.encode())
+    for filename, lines in languages:
+        yield filename, filter_language_diff(lines, blacklisted_ids), None
+
+
+def _ordered_map(executor, function, items, window):
+    # Like executor.map(), but only reads ahead "window" items, so not all of
+    # the diff is held in memory waiting for a worker.
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def string_id(line):
+    # Returns the id of a string, or None for comments, pragmas and empty lines.
+    if not line.strip() or line.startswith("#"):
+        return None
+    return line.split(":", 1)[0].strip()
+
+
+# A parsed language file: its lines, the string id of every line (None for
+# lines without a string), and a dict of id -> line.
+Language = collections.namedtuple("Language", "lines ids strings")
+
+
+def parse_language(content):
+    lines = content.decode().splitlines(keepends=True)
+    ids = [string_id(line) for line in lines]
+    strings = {id: line for id, line in zip(ids, lines) if id is not None}
+    return Language(lines, ids, strings)
+
+
+def merge_language(release, master, blacklisted_ids):
+    # The master version of the file, but with the release version of every
+    # blacklisted string. Blacklisted strings that no longer exist in master
+    # are kept after the string that preceded them in the release version.
+    kept = {}
+    anchor = None
+    for id, line in zip(release.ids, release.lines):
+        if id is None:
+            continue
+        if id in master.strings:
+            anchor = id
+        elif id in blacklisted_ids:
+            kept.setdefault(anchor, []).append(line)
+
+    output = []
+    pending = kept.get(None, [])
+    for id, line in zip(master.ids, master.lines):
+        if id is None:
+            output.append(line)
+            continue
+
+        output.extend(pending)
+        pending = []
+
+        if id not in blacklisted_ids:
+            output.append(line)
+        elif id in release.strings:
+            output.append(release.strings[id])
+        output.extend(kept.get(id, []))
+    output.extend(pending)
+
+    return output
+
+
+def changed_string_ids(english_release, english_master):
+    # Every string that changed in english.txt is blacklisted, and
+    # translations of these strings will not be backported.
+    return {
+        id for id in english_release.keys() | english_master.keys() if english_release.get(id) != english_master.get(id)
+    }
+
+
+def backport_languages_objects(language_files, diff_to_stdout=False):
+    # Returns a list of (language file, error) for languages that failed.
+    english_release = parse_language(git_session.read("HEAD:src/lang/english.txt")[1]).strings
+    english_master = parse_language(git_session.read("upstream/master:src/lang/english.txt")[1]).strings
+    blacklisted_ids = changed_string_ids(english_release, english_master)
+
+    errors = []
+    for language_file in language_files:
+        language_file = language_file.replace("\\", "/")
+        if language_file == "src/lang/english.txt":
+            continue
+        print("Backporting %s ..." % language_file[len("src/lang/") :])
+
+        release_oid, release_content = git_session.read(f"HEAD:{language_file}")
+        master_oid, master_content = git_session.read(f"upstream/master:{language_file}")
+        if release_oid is None or master_oid is None:
+            errors.append((language_file, "not found in both HEAD and upstream/master"))
+            continue
+        if release_oid == master_oid:
+            continue
+
+        release = parse_language(release_content)
+        output = merge_language(release, parse_language(master_content), blacklisted_ids)
+        if output == release.lines:
+            continue
+
+        if diff_to_stdout:
+            sys.stdout.writelines(
+                difflib.unified_diff(release.lines, output, f"a/{language_file}", f"b/{language_file}")
+            )
+            continue
+
+        with open(language_file, "w", encoding="utf-8", newline="") as fp:
+            fp.writelines(output)
+
+    return errors
+
+
+# The blacklist of every release, set once in every worker process.
+_release_blacklists = None
+
+
+def _init_release_worker(release_blacklists):
+    global _release_blacklists
+    _release_blacklists = release_blacklists
+
+
+def _merge_releases(item):
+    # Merge one language of master into every release that differs. Returns
+    # the language file and a list of (release, output, error); the output is
+    # the merged file (or its diff), or None if the release is up to date.
+    language_file, master_content, releases, diff = item
+    try:
+        master = parse_language(master_content)
+    except Exception as e:
+        return language_file, [(release, None, f"{type(e).__name__}: {e}") for release, _ in releases]
+
+    results = []
+    for release, release_content in releases:
+        try:
+            parsed = parse_language(release_content)
+            output = merge_language(parsed, master, _release_blacklists[release])
+        except Exception as e:
+            results.append((release, None, f"{type(e).__name__}: {e}"))
+            continue
+
+        if output == parsed.lines:
+            results.append((release, None, None))
+        elif diff:
+            diff_lines = difflib.unified_diff(parsed.lines, output, f"a/{language_file}", f"b/{language_file}")
+            results.append((release, "".join(diff_lines), None))
+        else:
+            results.append((release, "".join(output), None))
+    return language_file, results
+
+
+def languages_branch(release):
+    # The branch the languages of a release are committed to.
+    return "release-languages-" + release.rsplit("release/", 1)[-1].replace("/", "-")
+
+
+def commit_languages(release, outputs):
+    # Commit the merged language files on top of release, to its branch,
+    # without touching the index or the checkout. Returns the branch.
+    files = []
+    for language_file in sorted(outputs):
+        res = git_session.run_checked(["hash-object", "-w", "--stdin"], input=outputs[language_file].encode())
+        files.append(f"100644 {res.stdout.decode().strip()}\t{language_file}\n")
+
+    # A throw-away index, to create the tree of the release with the new files.
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(folder, "index"))
+        git_session.run_checked(["read-tree", release], env=env)
+        git_session.run_checked(["update-index", "--index-info"], input="".join(files).encode(), env=env)
+        tree = git_session.run_checked(["write-tree"], env=env).stdout.decode().strip()
+
+    res = git_session.run_checked(
+        [
+            "commit-tree",
+            tree,
+            "-p",
+            git_session.rev_parse(f"{release}^{{commit}}"),
+            "-m",
+            "Update: Backport language changes",
+        ]
+    )
+    branch = languages_branch(release)
+    git_session.run_checked(["update-ref", f"refs/heads/{branch}", res.stdout.decode().strip()])
+    return branch
+
+
+def backport_languages_releases(language_files, releases, diff_to_stdout=False, jobs=1):
+    # Backport the languages of upstream/master into every release at once.
+    # Returns a list of (release, language file, error); releases with an
+    # error get no commit.
+    errors = []
+    head = git_session.run(["symbolic-ref", "-q", "HEAD"]).stdout.decode().strip()
+    for release in releases:
+        if git_session.rev_parse(f"{release}^{{commit}}") is None:
+            errors.append((release, None, "not a commit"))
+        elif head == f"refs/heads/{languages_branch(release)}":
+            errors.append((release, None, f"its branch {languages_branch(release)} is checked out"))
+    if errors:
+        return errors
+
+    # What is on master is read and parsed once, for all releases.
+    master_oids = blob_oids("upstream/master")
+    english_master = parse_language(git_session.read("upstream/master:src/lang/english.txt")[1]).strings
+    release_oids = {}
+    blacklists = {}
+    for release in releases:
+        release_oids[release] = blob_oids(release)
+        english_release = parse_language(git_session.read(f"{release}:src/lang/english.txt")[1]).strings
+        blacklists[release] = changed_string_ids(english_release, english_master)
+
+    def languages():
+        # Yield the work per language, reading the blobs as they are needed.
+        for language_file in language_files:
+            language_file = language_file.replace("\\", "/")
+            if language_file == "src/lang/english.txt":
+                continue
+
+            master_oid = master_oids.get(language_file)
+            todo = [release for release in releases if release_oids[release].get(language_file) != master_oid]
+            for release in todo:
+                if master_oid is None or language_file not in release_oids[release]:
+                    errors.append((release, language_file, "not found in both the release and upstream/master"))
+            todo = [release for release in todo if master_oid is not None and language_file in release_oids[release]]
+            if not todo:
+                continue
+
+            master_content = git_session.read(master_oid)[1]
+            release_contents = [
+                (release, git_session.read(release_oids[release][language_file])[1]) for release in todo
+            ]
+            yield language_file, master_content, release_contents, diff_to_stdout
+
+    # Merging is pure Python; spread the languages over multiple processes.
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_release_worker, initargs=(blacklists,)
+        )
+        results = _ordered_map(executor, _merge_releases, languages(), jobs * 2)
+    else:
+        executor = None
+        _init_release_worker(blacklists)
+        results = map(_merge_releases, languages())
+
+    outputs = {release: {} for release in releases}
+    for language_file, release_results in results:
+        print("Backporting %s ..." % language_file[len("src/lang/") :])
+        for release, output, error in release_results:
+            if error is not None:
+                errors.append((release, language_file, error))
+            elif output is not None:
+                outputs[release][language_file] = output
+
+    if executor is not None:
+        executor.shutdown()
+
+    failed = {release for release, _, _ in errors}
+    for release in releases:
+        if release in failed:
+            continue
+        if not outputs[release]:
+            print(f"{release}: nothing to backport")
+        elif diff_to_stdout:
+            print(f"# {release}")
+            sys.stdout.writelines(outputs[release][language_file] for language_file in sorted(outputs[release]))
+        else:
+            branch = commit_languages(release, outputs[release])
+            print(f"{release}: backported {len(outputs[release])} languages to branch {branch}")
+
+    return errors
 
 
 def create_blacklisted_ids():
     # First check what changed in english.txt. Every change is blacklisted and
     # translations in these lines will not be backported
-    result = subprocess.run(
-        shlex.split("git diff HEAD..upstream/master -- src/lang/english.txt"), check=True, stdout=subprocess.PIPE
-    )
-
-    blacklisted_ids = []
+    blacklisted_ids = set()
 
     # Walk the diff line by line
-    for line in result.stdout.decode().split("\n"):
+    for line in diff_lines(["src/lang/english.txt"]):
         # Ignore headers
         if line.startswith(("---", "+++")) or not line:
             continue
@@ -91,7 +593,7 @@ def create_blacklisted_ids():
         if line.startswith(("-", "+")):
             # Store that id in a blacklist
             id = line[1:].split(":")[0]
-            blacklisted_ids.append(id)
+            blacklisted_ids.add(id)
 
     return blacklisted_ids
 
@@ -102,22 +604,63 @@ def parse_command_line():
         "languages", metavar="LANGUAGE", type=str, nargs="*", help="which languages to backport (empty for all)"
     )
     parser.add_argument("--diff", action="store_true", help="only show the diff; do not apply")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse the results of earlier runs")
+    parser.add_argument(
+        "--objects", action="store_true", help="merge the language files directly, instead of via a diff"
+    )
+    parser.add_argument(
+        "--release",
+        action="append",
+        help="backport into this release branch (instead of the checkout), committing to the branch "
+        "release-languages-<release>; can be given more than once",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="how many languages to process in parallel (default: number of CPUs)",
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_command_line()
 
-    blacklisted_ids = create_blacklisted_ids()
-
     if args.languages:
         language_files = ["src/lang/%s.txt" % language for language in args.languages]
+    elif args.release:
+        # The checkout doesn't matter here; take the languages of master.
+        language_files = [
+            path
+            for path in sorted(blob_oids("upstream/master"))
+            if path.endswith(".txt") and os.path.dirname(path) in ("src/lang", "src/lang/unfinished")
+        ]
     else:
         language_files = glob.glob("src/lang/*.txt") + glob.glob("src/lang/unfinished/*.txt")
 
-    for language_file in language_files:
-        print("Backporting %s ..." % language_file[len("src/lang/") :])
-        backport_language(language_file, blacklisted_ids, diff_to_stdout=args.diff)
+    if args.release:
+        errors = backport_languages_releases(language_files, args.release, diff_to_stdout=args.diff, jobs=args.jobs)
+        for release, language_file, error in errors:
+            if language_file is None:
+                print("ERROR: failed to backport into %s: %s" % (release, error))
+            else:
+                print("ERROR: failed to backport %s into %s: %s" % (language_file[len("src/lang/") :], release, error))
+        if errors:
+            sys.exit(1)
+        return
+
+    if args.objects:
+        errors = backport_languages_objects(language_files, diff_to_stdout=args.diff)
+    else:
+        blacklisted_ids = create_blacklisted_ids()
+        errors = backport_languages(
+            language_files, blacklisted_ids, diff_to_stdout=args.diff, jobs=args.jobs, use_cache=not args.no_cache
+        )
+    for language_file, error in errors:
+        print("ERROR: failed to backport %s: %s" % (language_file[len("src/lang/") :], error))
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
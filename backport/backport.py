@@ -1,6 +1,7 @@
 """
 Put this file in a master checkout under .github/.
-It should be next to backport-languages.py.
+It should be next to backport-languages.py, github_api.py, git_session.py and
+tracing.py.
 
 This assumes your git "origin" points to your fork, and "upstream" to upstream.
 This will force-push to a branch called "release-backport".
@@ -17,17 +18,62 @@ $ python3 .github/backport.py
 And follow the instructions. After the PR is merged, run:
 
 $ python3 .github/backport.py --mark-done <PR-NUMBER>
+
+When resuming after a conflict, the PRs fetched from GitHub the first time
+are used again; add --refresh to fetch them again (also skipping the response
+cache of github_api.py).
+
+Running the script again on top of an existing "release-backport" only
+cherry-picks what is not on it yet: commits the script made (also the ones
+whose conflicts were resolved by hand) are remembered in .backport-applied,
+others are recognised by their patch-id. If the branch has a commit that
+belongs to none of the PRs, it starts over from the release branch.
+
+To see which commits will conflict before starting a backport, run:
+
+$ python3 .github/backport.py --plan
+
+This simulates all cherry-picks with "git merge-tree" (git 2.38 or newer),
+without touching your checkout.
+
+Add --profile to record where the time goes (GitHub, git, and the phases of
+the run); this is written to backport-profile.json, in the Chrome trace-event
+format.
 """
 
+import concurrent.futures
 import json
 import os
 import subprocess
 import sys
 
-BEARER_TOKEN = os.getenv("GITHUB_TOKEN")
+import git_session
+import github_api
+import tracing
+
 USERNAME = os.getenv("GITHUB_USERNAME")
 # NOTE: Replace with the version branch to backport to
 RELEASE = "13"
+# How many PRs to relabel in a single GraphQL mutation.
+LABEL_BATCH_SIZE = 25
+# How many REST requests to run in parallel if the GraphQL mutation fails.
+LABEL_REST_WORKERS = 4
+# Cache of the patch-ids of the commits already on the release branch.
+PATCH_ID_CACHE = ".backport-patch-ids"
+# Bump when the patch-ids change.
+PATCH_ID_VERSION = 2
+# The commits made on "release-backport", and the commit each was
+# cherry-picked from (or LANGUAGES for the language changes).
+APPLIED_COMMITS = ".backport-applied"
+LANGUAGES = "languages"
+# What was fetched from GitHub, so resuming doesn't have to fetch it again.
+CHECKPOINT = ".backport-checkpoint"
+# Bump when the content of the checkpoint changes.
+CHECKPOINT_VERSION = 2
+# Where the trace of --profile is written.
+PROFILE_FILENAME = "backport-profile.json"
+# How many conflicting PRs to simulate on their own in parallel with --plan.
+PLAN_WORKERS = os.cpu_count() or 4
 
 pr_query = """
 query ($number: Int!) {
@@ -40,9 +86,13 @@ query ($number: Int!) {
 """
 
 pr_search_query = """
-query ($search: String!) {
-  search(query: $search, type: ISSUE, first: 100) {
+query ($search: String!, $after: String) {
+  search(query: $search, type: ISSUE, first: 100, after: $after) {
     issueCount
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
     edges {
       node {
         ... on PullRequest {
@@ -50,6 +100,10 @@ query ($search: String!) {
           title
           commits(first: 100) {
             totalCount
+            pageInfo {
+              hasNextPage
+              endCursor
+            }
             nodes {
               commit {
                 messageHeadline
@@ -72,69 +126,417 @@ query ($search: String!) {
 }
 """
 
+pr_commits_query = """
+query ($number: Int!, $after: String) {
+  repository(owner: "OpenTTD", name: "OpenTTD") {
+    pullRequest(number: $number) {
+      commits(first: 100, after: $after) {
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
+        nodes {
+          commit {
+            messageHeadline
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
 
 def do_query(query, variables):
-    query = query.replace("\n", "").replace("\\", "\\\\").replace('"', '\\"')
-    variables = json.dumps(variables).replace("\\", "\\\\").replace('"', '\\"')
-    res = subprocess.run(
-        [
-            "curl",
-            "--fail",
-            "-H",
-            f"Authorization: bearer {BEARER_TOKEN}",
-            "-X",
-            "POST",
-            "-d",
-            f'{{"query": "{query}", "variables": "{variables}"}}',
-            "https://api.github.com/graphql",
-        ],
-        capture_output=True,
-    )
-    if res.returncode != 0:
-        return None
-    return json.loads(res.stdout)
+    return github_api.do_query(query, variables)
 
 
 def do_remove_label(number):
-    return subprocess.run(
-        [
-            "curl",
-            "--fail",
-            "-H",
-            f"Authorization: bearer {BEARER_TOKEN}",
-            "-X",
-            "DELETE",
-            f"https://api.github.com/repos/OpenTTD/OpenTTD/issues/{number}/labels/backport%20requested",
-        ],
-        capture_output=True,
+    return (
+        github_api.do_rest("DELETE", f"/repos/OpenTTD/OpenTTD/issues/{number}/labels/backport%20requested") is not None
     )
 
 
 def do_add_label(number):
-    return subprocess.run(
-        [
-            "curl",
-            "--fail",
-            "-H",
-            f"Authorization: bearer {BEARER_TOKEN}",
-            "-X",
-            "POST",
-            "-d",
-            '{"labels": ["backported"]}',
-            f"https://api.github.com/repos/OpenTTD/OpenTTD/issues/{number}/labels",
-        ],
-        capture_output=True,
+    return (
+        github_api.do_rest("POST", f"/repos/OpenTTD/OpenTTD/issues/{number}/labels", {"labels": ["backported"]})
+        is not None
     )
 
 
-def do_command(command):
-    return subprocess.run(command, capture_output=True)
+def fetch_backport_prs():
+    # Returns the search edges of all PRs marked for backport, with all their
+    # commits, or None if GitHub couldn't be queried.
+    search = 'is:closed is:pr label:"backport requested" repo:OpenTTD/OpenTTD'
+
+    edges = []
+    try:
+        for page in github_api.paginate(pr_search_query, {"search": search}, lambda data: data["search"]):
+            for edge in page["search"]["edges"]:
+                commits = edge["node"]["commits"]
+                if commits["pageInfo"]["hasNextPage"]:
+                    # More than one page of commits; fetch the rest of them.
+                    pages = github_api.paginate(
+                        pr_commits_query,
+                        {"number": edge["node"]["number"], "after": commits["pageInfo"]["endCursor"]},
+                        lambda data: data["repository"]["pullRequest"]["commits"],
+                    )
+                    for commit_page in pages:
+                        commits["nodes"].extend(commit_page["repository"]["pullRequest"]["commits"]["nodes"])
+
+                edges.append(edge)
+    except github_api.QueryError:
+        return None
+
+    return edges
+
+
+def fetch_label_node_ids(prs):
+    # GraphQL mutations work on node IDs; look up the labels and all PRs in one go.
+    fields = " ".join(f"pr{pr}: pullRequest(number: {pr}) {{ id }}" for pr in prs)
+    query = (
+        'query { repository(owner: "OpenTTD", name: "OpenTTD") { '
+        'requested: label(name: "backport requested") { id } '
+        'backported: label(name: "backported") { id } '
+        f"{fields} }} }}"
+    )
+
+    res = do_query(query, {})
+    if res is None or not res.get("data"):
+        return None
+    repository = res["data"]["repository"]
+    if not repository.get("requested") or not repository.get("backported"):
+        return None
+
+    pr_ids = {}
+    for pr in prs:
+        if repository.get(f"pr{pr}"):
+            pr_ids[pr] = repository[f"pr{pr}"]["id"]
+    return repository["requested"]["id"], repository["backported"]["id"], pr_ids
+
+
+def mark_done_batched(prs):
+    # Returns a dict of PR -> error (None on success). PRs that are missing
+    # from the result could not be handled and should be retried over REST.
+    results = {}
+
+    ids = fetch_label_node_ids(prs)
+    if ids is None:
+        return results
+    requested_id, backported_id, pr_ids = ids
+
+    for start in range(0, len(prs), LABEL_BATCH_SIZE):
+        batch = prs[start : start + LABEL_BATCH_SIZE]
+
+        declarations = ["$remove: [ID!]!", "$add: [ID!]!"]
+        fields = []
+        variables = {"remove": [requested_id], "add": [backported_id]}
+        for pr in batch:
+            if pr not in pr_ids:
+                results[pr] = "pull request not found"
+                continue
+
+            declarations.append(f"$pr{pr}: ID!")
+            variables[f"pr{pr}"] = pr_ids[pr]
+            fields.append(
+                f"remove{pr}: removeLabelsFromLabelable(input: {{labelableId: $pr{pr}, labelIds: $remove}}) "
+                "{ clientMutationId }"
+            )
+            fields.append(
+                f"add{pr}: addLabelsToLabelable(input: {{labelableId: $pr{pr}, labelIds: $add}}) "
+                "{ clientMutationId }"
+            )
+        if not fields:
+            continue
+
+        mutation = f"mutation ({', '.join(declarations)}) {{ {' '.join(fields)} }}"
+        res = do_query(mutation, variables)
+        if res is None:
+            continue
+
+        # Errors carry the alias of the field that failed as first path element.
+        errors = {}
+        for error in res.get("errors", []):
+            alias = (error.get("path") or [""])[0]
+            for action in ("remove", "add"):
+                if alias.startswith(action) and alias[len(action) :].isdigit():
+                    errors.setdefault(int(alias[len(action) :]), []).append(f"{action}: {error.get('message')}")
+                    break
+            else:
+                # An error we cannot attribute to a single PR; retry the whole batch over REST.
+                errors = None
+                break
+        if errors is None:
+            continue
+
+        for pr in batch:
+            if pr in pr_ids:
+                results[pr] = "; ".join(errors[pr]) if pr in errors else None
+
+    return results
+
+
+def mark_done_rest(pr):
+    errors = []
+    if not do_remove_label(pr):
+        errors.append("failed to remove 'backport requested' label")
+    if not do_add_label(pr):
+        errors.append("failed to add 'backported' label")
+    return "; ".join(errors) if errors else None
+
+
+def resolve_revisions(revisions):
+    # Resolve many revisions to commit hashes in one go. Revisions that don't
+    # exist are left out.
+    return {revision: oid for revision, oid in zip(revisions, git_session.resolve(revisions)) if oid is not None}
+
+
+def detect_squashed_prs(prs):
+    # In case of multiple commits, check if it was squashed or rebased.
+    # We do this by comparing commit titles. As if you rebased, they have
+    # to be identical.
+    # Rather than asking git for every commit, resolve the first-parent chains
+    # of all merge commits in one go, and compare the titles in memory.
+    revisions = []
+    for pr in prs:
+        count = pr["node"]["commits"]["totalCount"]
+        if count <= 1:
+            continue
+        for i in range(count):
+            revisions.append(f'{pr["node"]["mergeCommit"]["oid"]}~{count - i - 1}')
+    if not revisions:
+        return set()
+
+    oids = resolve_revisions(revisions)
+    unique_oids = set(oids.values())
+    titles = {}
+    if unique_oids:
+        for line in git_session.log([], "%H %s", revisions=unique_oids):
+            oid, _, title = line.partition(" ")
+            titles[oid] = title
+
+    squashed = set()
+    for pr in prs:
+        count = pr["node"]["commits"]["totalCount"]
+        if count <= 1:
+            continue
+        for i in range(count):
+            oid = oids.get(f'{pr["node"]["mergeCommit"]["oid"]}~{count - i - 1}')
+            if titles.get(oid) != pr["node"]["commits"]["nodes"][i]["commit"]["messageHeadline"]:
+                squashed.add(pr["node"]["number"])
+                break
+
+    return squashed
+
+
+def load_applied_patch_ids(tip):
+    # The patch-ids of all commits on the release branch (that are not on
+    # master), up to tip. The result is cached; if the branch only grew since
+    # the last run, only the new commits are looked at.
+    applied = None
+    if os.path.exists(PATCH_ID_CACHE):
+        with open(PATCH_ID_CACHE, "r") as fp:
+            cache = json.load(fp)
+        if cache.get("version") != PATCH_ID_VERSION:
+            pass
+        elif cache["tip"] == tip:
+            return set(cache["patch_ids"])
+        elif git_session.run(["merge-base", "--is-ancestor", cache["tip"], tip]).returncode == 0:
+            applied = set(cache["patch_ids"])
+            applied.update(git_session.patch_ids([tip, f"^{cache['tip']}", "^upstream/master"]).values())
+
+    if applied is None:
+        applied = set(git_session.patch_ids([tip, "^upstream/master"]).values())
+
+    with open(PATCH_ID_CACHE, "w") as fp:
+        json.dump({"version": PATCH_ID_VERSION, "tip": tip, "patch_ids": sorted(applied)}, fp)
+    return applied
+
+
+def load_applied_commits():
+    # Returns a dict of commit on "release-backport" -> the commit it was
+    # cherry-picked from.
+    if not os.path.exists(APPLIED_COMMITS):
+        return {}
+    with open(APPLIED_COMMITS, "r") as fp:
+        applied_commits = json.load(fp)
+    if applied_commits.get("release") != RELEASE:
+        return {}
+    return applied_commits["commits"]
+
+
+def save_applied_commits(applied_commits):
+    with open(APPLIED_COMMITS, "w") as fp:
+        json.dump({"release": RELEASE, "commits": applied_commits}, fp)
+
+
+def find_reusable_backport(release_head, originals, patch_ids, applied_commits):
+    # Returns where an earlier "release-backport" on top of release_head can be
+    # continued from, or None if it can't be: when one of its commits isn't
+    # one of the originals (the commits of the PRs), it would end up in the
+    # backport without being mentioned. Language changes at the top are left
+    # out; they are done again at the end.
+    existing = git_session.rev_parse("release-backport")
+    if existing is None or existing == release_head:
+        return None
+    if git_session.run(["merge-base", "--is-ancestor", release_head, existing]).returncode != 0:
+        return None
+
+    commits = git_session.log([f"{release_head}..{existing}"], "%H")
+    if applied_commits.get(commits[0]) == LANGUAGES:
+        existing = git_session.read_commit(commits[0]).parents[0]
+        commits = commits[1:]
+
+    unknown = [commit for commit in commits if applied_commits.get(commit) not in originals]
+    if unknown:
+        wanted = {patch_ids[original] for original in originals if original in patch_ids}
+        found = git_session.patch_ids([], revisions=unknown)
+        if any(found.get(commit) not in wanted for commit in unknown):
+            return None
+    return existing
+
+
+def load_checkpoint():
+    if not os.path.exists(CHECKPOINT):
+        return None
+    with open(CHECKPOINT, "r") as fp:
+        checkpoint = json.load(fp)
+    if checkpoint.get("version") != CHECKPOINT_VERSION or checkpoint.get("release") != RELEASE:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(prs, squashed, oids, patch_ids):
+    with open(CHECKPOINT, "w") as fp:
+        json.dump(
+            {
+                "version": CHECKPOINT_VERSION,
+                "release": RELEASE,
+                "prs": prs,
+                "squashed": sorted(squashed),
+                "oids": oids,
+                "patch_ids": patch_ids,
+            },
+            fp,
+        )
+
+
+def pr_commits(pr):
+    # The commits of a rebased PR are the first-parent ancestors of its merge commit.
+    count = pr["node"]["commits"]["totalCount"]
+    return [f'{pr["node"]["mergeCommit"]["oid"]}~{count - i - 1}' for i in range(count)]
+
+
+class MergeTreeError(Exception):
+    pass
+
+
+def git_supports_merge_base():
+    # "git merge-tree --merge-base" was added in git 2.40, but only accepts
+    # trees (instead of commits) to merge since git 2.44.
+    version = git_session.run(["version"]).stdout.decode().split()[2]
+    major, minor = version.split(".")[0:2]
+    return (int(major), int(minor)) >= (2, 44)
+
+
+def commit_tree(tree, parent=None):
+    command = ["commit-tree", tree, "-m", "backport simulation"]
+    if parent:
+        command.extend(["-p", parent])
+    return git_session.run(command).stdout.decode().strip()
+
+
+def simulate_cherry_pick(tree, commit, merge_base_supported):
+    # Returns the tree after cherry-picking commit on top of tree, and the list
+    # of conflicting files. Nothing is written to the index or worktree.
+    # Raises MergeTreeError if git couldn't do the merge at all.
+    if merge_base_supported:
+        res = git_session.run(["merge-tree", "--write-tree", "--name-only", f"--merge-base={commit}^", tree, commit])
+    else:
+        # Older git can't be told what the merge-base is; create throw-away
+        # commits that have the parent of the commit as common ancestor.
+        base = commit_tree(f"{commit}^^{{tree}}")
+        ours = commit_tree(tree, base)
+        theirs = commit_tree(f"{commit}^{{tree}}", base)
+        res = git_session.run(["merge-tree", "--write-tree", "--name-only", ours, theirs])
+
+    lines = res.stdout.decode().split("\n")
+    if res.returncode not in (0, 1) or not lines[0]:
+        raise MergeTreeError(res.stderr.decode().strip() or f"git merge-tree exited with {res.returncode}")
+
+    conflicts = []
+    for line in lines[1:]:
+        if not line:
+            break
+        if line not in conflicts:
+            conflicts.append(line)
+    return lines[0], conflicts
+
+
+def cherry_pick_objects(parent, parent_tree, commit, merge_base_supported):
+    # Cherry-pick commit on top of parent purely with git objects. Returns the
+    # new commit and its tree; the commit is None if nothing changed, and the
+    # tree is None if the cherry-pick conflicts.
+    tree, conflicts = simulate_cherry_pick(parent_tree, commit, merge_base_supported)
+    if conflicts:
+        return None, None
+    if tree == parent_tree:
+        return None, tree
+
+    # Like "git cherry-pick", keep the original author and message.
+    original = git_session.read_commit(commit)
+    author = original.author
+    env = dict(os.environ, GIT_AUTHOR_NAME=author.name, GIT_AUTHOR_EMAIL=author.email, GIT_AUTHOR_DATE=author.date)
+
+    res = git_session.run(["commit-tree", tree, "-p", parent, "-F", "-"], input=original.message.encode(), env=env)
+    if res.returncode != 0:
+        return None, None
+    return res.stdout.decode().strip(), tree
+
+
+def simulate_backport(base, prs, merge_base_supported):
+    # Returns a dict of PR number -> list of (commit index, commit, conflicts).
+    # A conflicting commit is left out, and the simulation continues as if it
+    # had been resolved by dropping it.
+    conflict_map = {}
+    tree = base
+    for pr in prs:
+        for i, commit in enumerate(pr_commits(pr)):
+            new_tree, conflicts = simulate_cherry_pick(tree, commit, merge_base_supported)
+            if conflicts:
+                conflict_map.setdefault(pr["node"]["number"], []).append((i, commit, conflicts))
+            else:
+                tree = new_tree
+    return conflict_map
+
+
+def plan_backport(prs):
+    base = f"upstream/release/{RELEASE}^{{tree}}"
+    merge_base_supported = git_supports_merge_base()
+
+    # The real sequence first. Only PRs that conflict in there are tried on
+    # their own against the release branch, to find the ones that only
+    # conflict because of earlier backports; these are independent, so they
+    # run in parallel.
+    conflict_map = simulate_backport(base, prs, merge_base_supported)
+    conflicting = [pr for pr in prs if pr["node"]["number"] in conflict_map]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PLAN_WORKERS) as executor:
+        standalone = executor.map(lambda pr: simulate_backport(base, [pr], merge_base_supported), conflicting)
+        standalone_conflicts = set()
+        for standalone_map in standalone:
+            standalone_conflicts.update(standalone_map.keys())
+
+    return conflict_map, standalone_conflicts
 
 
 def main():
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        tracing.enable(PROFILE_FILENAME)
+
     if len(sys.argv) > 1 and sys.argv[1] == "--mark-done":
         backport_pr = do_query(pr_query, {"number": int(sys.argv[2])})
-        if backport_pr is None:
+        if backport_pr is None or not backport_pr.get("data"):
             print("ERROR: couldn't fetch backport PR")
             return
 
@@ -143,21 +545,72 @@ def main():
                 prs = [int(pr) for pr in line.split(":")[1].split(" ")[1].split(",")]
 
         print("Update labels from backported PRs")
-        for pr in prs:
-            print(f"- #{pr} ..")
-            res = do_remove_label(pr)
-            if res.returncode != 0:
-                print(f"ERROR: failed to remove label from {pr}")
-            res = do_add_label(pr)
-            if res.returncode != 0:
-                print(f"ERROR: failed to add label to {pr}")
+        results = mark_done_batched(prs)
 
+        remaining = [pr for pr in prs if pr not in results]
+        if remaining:
+            print(f"Updating {len(remaining)} PRs via the REST API ..")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=LABEL_REST_WORKERS) as executor:
+                results.update(zip(remaining, executor.map(mark_done_rest, remaining)))
+
+        for pr in prs:
+            if results[pr] is None:
+                print(f"- #{pr}: done")
+            else:
+                print(f"- #{pr}: ERROR: {results[pr]}")
+
+        failed = sum(1 for pr in prs if results[pr] is not None)
+        if failed:
+            print(f"{failed} of {len(prs)} PRs failed to update")
         print("All done")
+        github_api.print_timings()
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--plan":
+        with tracing.span("phase", "fetch upstream"):
+            git_session.run(["fetch", "upstream"])
+
+        with tracing.span("phase", "fetch PRs"):
+            all_prs = fetch_backport_prs()
+        if all_prs is None:
+            print("ERROR: couldn't fetch all Pull Requests marked for 'backport requested'")
+            return
+
+        prs = sorted(all_prs, key=lambda x: x["node"]["mergedAt"])
+        with tracing.span("phase", "detect squashed PRs"):
+            squashed = detect_squashed_prs(prs)
+        for pr in prs:
+            if pr["node"]["number"] in squashed:
+                pr["node"]["commits"]["totalCount"] = 1
+
+        print(f"Simulating backport of {len(prs)} PRs ..")
+        with tracing.span("phase", "simulate backport"):
+            try:
+                conflict_map, standalone_conflicts = plan_backport(prs)
+            except MergeTreeError as e:
+                print(f"ERROR: couldn't simulate the backport: {e}")
+                return
+
+        for pr in prs:
+            if pr["node"]["number"] not in conflict_map:
+                continue
+            print(f"#{pr['node']['number']}: {pr['node']['title']}")
+            for i, commit, conflicts in conflict_map[pr["node"]["number"]]:
+                print(f"  Commit #{i}: {commit}: {', '.join(conflicts)}")
+            if pr["node"]["number"] not in standalone_conflicts:
+                print("  -> only conflicts because of earlier backports")
+
+        commits = sum(len(conflicts) for conflicts in conflict_map.values())
+        if commits:
+            print(f"{commits} commits in {len(conflict_map)} PRs are expected to conflict")
+        else:
+            print("No conflicts expected")
         return
 
-    dont_push = False
-    if len(sys.argv) > 1 and sys.argv[1] == "--dont-push":
-        dont_push = True
+    dont_push = "--dont-push" in sys.argv[1:]
+    refresh = "--refresh" in sys.argv[1:]
+    if refresh:
+        github_api.refresh_cache()
 
     resume = None
     resume_i = None
@@ -168,16 +621,75 @@ def main():
             resume_i = int(resume_i_str)
         print(f"Resuming backporting from {resume}")
 
-    all_prs = do_query(pr_search_query, {"search": 'is:closed is:pr label:"backport requested" repo:OpenTTD/OpenTTD'})
-    if all_prs is None:
-        print("ERROR: couldn't fetch all Pull Requests marked for 'backport requested'")
-        return
+    # When resuming, reuse what we fetched and computed the first time.
+    checkpoint = None
+    if resume and not refresh:
+        checkpoint = load_checkpoint()
+
+    if checkpoint is None:
+        with tracing.span("phase", "fetch PRs"):
+            all_prs = fetch_backport_prs()
+        if all_prs is None:
+            print("ERROR: couldn't fetch all Pull Requests marked for 'backport requested'")
+            return
+        all_prs = sorted(all_prs, key=lambda x: x["node"]["mergedAt"])
+    else:
+        print("Using the PRs fetched earlier; use --refresh to fetch them again")
+        all_prs = checkpoint["prs"]
+
+    if checkpoint is None:
+        with tracing.span("phase", "prepare commits"):
+            squashed = detect_squashed_prs(all_prs)
+            for pr in all_prs:
+                if pr["node"]["number"] in squashed:
+                    pr["node"]["commits"]["totalCount"] = 1
 
+            revisions = [commit for pr in all_prs for commit in pr_commits(pr)]
+            oids = resolve_revisions(revisions)
+            patch_ids = git_session.patch_ids([], revisions=set(oids.values()))
+        save_checkpoint(all_prs, squashed, oids, patch_ids)
+    else:
+        squashed = set(checkpoint["squashed"])
+        oids = checkpoint["oids"]
+        patch_ids = checkpoint["patch_ids"]
+
+    # Commits are created without touching the checkout; only when a
+    # cherry-pick conflicts, or when we are done, "release-backport" is
+    # checked out.
+    # If an earlier run left a "release-backport" on top of the current
+    # release branch, with only commits of these PRs, continue from there;
+    # commits that are already on it are skipped.
+    originals = set(oids.values())
+    applied_commits = load_applied_commits()
     if not resume:
-        do_command(["git", "fetch", "upstream"])
-        do_command(["git", "checkout", f"upstream/release/{RELEASE}", "-B", "release-backport"])
+        with tracing.span("phase", "fetch upstream"):
+            git_session.run(["fetch", "upstream"])
+        release_head = git_session.rev_parse(f"upstream/release/{RELEASE}")
+        head = find_reusable_backport(release_head, originals, patch_ids, applied_commits)
+        if head is None:
+            if git_session.rev_parse("release-backport") not in (None, release_head):
+                print(
+                    "Starting over from the release branch; release-backport has commits of other PRs, or is outdated"
+                )
+            head = release_head
+            applied_commits = {}
+        else:
+            print("Continuing from the existing release-backport")
+    else:
+        release_head = git_session.rev_parse(f"upstream/release/{RELEASE}")
+        head = git_session.rev_parse("release-backport")
+    head_tree = git_session.rev_parse(f"{head}^{{tree}}")
+    merge_base_supported = git_supports_merge_base()
 
-    for pr in sorted(all_prs["data"]["search"]["edges"], key=lambda x: x["node"]["mergedAt"]):
+    # The originals that are on the branch already, also when their
+    # conflicts were resolved by hand.
+    on_branch = git_session.log([f"{release_head}..{head}"], "%H") if head != release_head else []
+    applied_originals = {applied_commits[commit] for commit in on_branch if commit in applied_commits}
+
+    with tracing.span("phase", "load applied patch-ids"):
+        applied = load_applied_patch_ids(head)
+
+    for pr in all_prs:
         if resume:
             if resume != pr["node"]["number"]:
                 continue
@@ -186,55 +698,81 @@ def main():
         else:
             print(f"Merging #{pr['node']['number']}: {pr['node']['title']}")
 
-        # In case of multiple commits, check if it was squashed or rebased.
-        # We do this by comparing commit titles. As if you rebased, they have
-        # to be identical.
-        if pr["node"]["commits"]["totalCount"] > 1:
-            for i in range(pr["node"]["commits"]["totalCount"]):
-                commit = pr["node"]["commits"]["totalCount"] - i - 1
-                commit_str = f'{pr["node"]["mergeCommit"]["oid"]}' + "".join(["^"] * commit)
-
-                res = do_command(["git", "log", "--pretty=format:%s", f"{commit_str}^..{commit_str}"])
-                if res.stdout.decode() != pr["node"]["commits"]["nodes"][i]["commit"]["messageHeadline"]:
-                    print("  -> was squashed")
-                    pr["node"]["commits"]["totalCount"] = 1
-                    break
-
-        for i in range(pr["node"]["commits"]["totalCount"]):
-            if resume_i is not None:
-                if resume_i != i:
+        if pr["node"]["number"] in squashed:
+            print("  -> was squashed")
+
+        with tracing.span("phase", "cherry-pick PR", pr=pr["node"]["number"]):
+            for i, commit_str in enumerate(pr_commits(pr)):
+                if resume_i is not None:
+                    if resume_i != i:
+                        continue
+                    resume_i = None
+                    # This one was resolved by hand, and committed on top.
+                    if head != release_head and head not in applied_commits and oids.get(commit_str):
+                        applied_commits[head] = oids[commit_str]
+                        save_applied_commits(applied_commits)
                     continue
-                resume_i = None
-                continue
 
-            commit = pr["node"]["commits"]["totalCount"] - i - 1
-            commit_str = f'{pr["node"]["mergeCommit"]["oid"]}' + "".join(["^"] * commit)
+                print(f"  Commit #{i}: {commit_str} ...")
 
-            print(f"  Commit #{i}: {commit_str} ...")
+                patch_id = patch_ids.get(oids.get(commit_str))
+                if patch_id in applied or oids.get(commit_str) in applied_originals:
+                    print("  -> already applied; skipped")
+                    continue
 
-            res = do_command(["git", "cherry-pick", commit_str])
-            if res.returncode != 0:
-                with open(".backport-resume", "w") as fp:
-                    fp.write(str(pr["node"]["number"]) + "," + str(i))
-                print(res.stdout.decode())
-                print("")
-                print("Cherry-pick failed: please fix the issue manually and run script again.")
-                return
+                try:
+                    commit, tree = cherry_pick_objects(head, head_tree, commit_str, merge_base_supported)
+                except MergeTreeError as e:
+                    print(f"  -> git merge-tree failed ({e}); cherry-picking in the checkout instead")
+                    commit, tree = None, None
+                if tree is None:
+                    # Needs a human; hand over to a normal cherry-pick in the checkout.
+                    git_session.run(["checkout", "-B", "release-backport", head])
+                    res = git_session.run(["cherry-pick", commit_str])
+                    if res.returncode != 0:
+                        save_applied_commits(applied_commits)
+                        with open(".backport-resume", "w") as fp:
+                            fp.write(str(pr["node"]["number"]) + "," + str(i))
+                        print(res.stdout.decode())
+                        print("")
+                        print("Cherry-pick failed: please fix the issue manually and run script again.")
+                        return
+
+                    commit = git_session.rev_parse("HEAD")
+                    tree = git_session.rev_parse(f"{commit}^{{tree}}")
+
+                if commit is None:
+                    print("  -> nothing to apply; skipped")
+                    continue
+                head, head_tree = commit, tree
+                if patch_id:
+                    applied.add(patch_id)
+                if oids.get(commit_str):
+                    applied_commits[commit] = oids[commit_str]
+
+    git_session.run(["checkout", "-B", "release-backport", head])
+    save_applied_commits(applied_commits)
 
     if os.path.exists(".backport-resume"):
         os.unlink(".backport-resume")
+    if os.path.exists(CHECKPOINT):
+        os.unlink(CHECKPOINT)
 
     print("")
     print("Done cherry-picking")
     print("Backporting language changes")
-    res = do_command(
-        [sys.executable or "python3", os.path.dirname(os.path.realpath(__file__)) + "/backport-languages.py"]
-    )
+    with tracing.span("phase", "backport languages"):
+        res = subprocess.run(
+            [sys.executable or "python3", os.path.dirname(os.path.realpath(__file__)) + "/backport-languages.py"],
+            capture_output=True,
+        )
     if res.returncode != 0:
         print("ERROR: backporting language changes failed")
         return
-    do_command(["git", "add", "src/lang/*.txt"])
-    do_command(["git", "commit", "-m", "Update: Backport language changes"])
+    git_session.run(["add", "src/lang/*.txt"])
+    if git_session.run(["commit", "-m", "Update: Backport language changes"]).returncode == 0:
+        applied_commits[git_session.rev_parse("HEAD")] = LANGUAGES
+        save_applied_commits(applied_commits)
     print("Done backporting language changes")
     print("")
 
@@ -245,7 +783,7 @@ def main():
 
     print("## Description")
     print(f"Backport of all closed Pull Requests labeled as 'backport requested' into `release/{RELEASE}`.")
-    for pr in sorted(all_prs["data"]["search"]["edges"], key=lambda x: x["node"]["mergedAt"]):
+    for pr in all_prs:
         print(f"- https://github.com/OpenTTD/OpenTTD/pull/{pr['node']['number']}")
         marker.append(str(pr["node"]["number"]))
     print("- All language changes")
@@ -258,7 +796,7 @@ def main():
         print(" git push -f --set-upstream origin release-backport")
         print("After that, go to this URL:")
     else:
-        res = do_command(["git", "push", "-f", "--set-upstream", "origin", "release-backport"])
+        res = git_session.run(["push", "-f", "--set-upstream", "origin", "release-backport"])
         if res.returncode != 0:
             print("ERROR: failed to push to remote")
         else:
@@ -270,6 +808,8 @@ def main():
         f":release-backport?expand=1&title=Backport%20master%20into%20release%2f{RELEASE}"
     )
 
+    github_api.print_timings()
+
 
 if __name__ == "__main__":
     main()
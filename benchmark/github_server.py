@@ -0,0 +1,276 @@
+"""
+A local stand-in for the GitHub API, replaying what make_repo.py wrote to
+github.json; this way the scripts can be benchmarked without GitHub.
+
+Execute with:
+
+$ python3 benchmark/github_server.py benchmark-repo/github.json --port 8080 --latency 0.1
+
+and point the scripts to it with GITHUB_API_URL=http://127.0.0.1:8080.
+
+It answers the queries of backport.py and changelog.py: the search for PRs
+to backport (pr_search_query) and the rest of their commits, the history of
+master (commit_pr_query), looking up commits and PRs by hash and number, and
+relabeling PRs.
+Every request waits for the configured latency first. Connections come in
+pages of at most --page-size nodes, and after --rate-limit requests every
+request is refused (with the same headers as GitHub) until the limit resets,
+--rate-limit-window seconds later.
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import re
+import threading
+import time
+
+# How long the rate limit lasts before it resets, in seconds.
+RATE_LIMIT_WINDOW = 3600
+
+OBJECT_FIELD = re.compile(r'(c\d+): object\(oid: "([0-9a-f]+)"\)')
+PULL_REQUEST_FIELD = re.compile(r"(pr(\d+)): pullRequest\(number: (\d+)\)")
+MUTATION_FIELD = re.compile(r"((?:remove|add)\d+): \w+\(")
+
+
+class Replay:
+    # Answers GraphQL queries from the metadata of make_repo.py.
+
+    def __init__(self, metadata, page_size):
+        self.history = metadata["history"]
+        self.prs = {int(number): pr for number, pr in metadata["prs"].items()}
+        self.page_size = page_size
+        self._commits = {commit["oid"]: commit for commit in self.history}
+
+    def _page(self, items, after):
+        # Returns a page of items, and its pageInfo. Cursors are offsets.
+        start = int(after) if after else 0
+        end = start + self.page_size
+        page_info = {"hasNextPage": end < len(items), "endCursor": str(min(end, len(items)))}
+        return items[start:end], page_info
+
+    def _commit_node(self, commit):
+        edges = []
+        if commit["pr"] is not None:
+            pr = self.prs[commit["pr"]]
+            edges.append(
+                {
+                    "node": {
+                        "number": commit["pr"],
+                        "labels": {"edges": [{"node": {"name": label}} for label in pr["labels"]]},
+                        "closingIssuesReferences": {"edges": [{"node": {"number": issue}} for issue in pr["issues"]]},
+                    }
+                }
+            )
+        return {"oid": commit["oid"], "associatedPullRequests": {"edges": edges}}
+
+    def _pr_commits(self, pr, after=None):
+        commits, page_info = self._page(pr["commits"], after)
+        return {
+            "totalCount": len(pr["commits"]),
+            "pageInfo": page_info,
+            "nodes": [{"commit": {"messageHeadline": message}} for message in commits],
+        }
+
+    def search(self, variables):
+        label = re.search(r'label:"([^"]+)"', variables["search"]).group(1)
+        numbers = sorted(number for number, pr in self.prs.items() if label in pr["labels"])
+        page, page_info = self._page(numbers, variables.get("after"))
+        edges = []
+        for number in page:
+            pr = self.prs[number]
+            edges.append(
+                {
+                    "node": {
+                        "number": number,
+                        "title": pr["title"],
+                        "commits": self._pr_commits(pr),
+                        "mergedAt": pr["mergedAt"],
+                        "mergeCommit": {"oid": pr["mergeCommit"]},
+                        "labels": {"nodes": [{"name": name} for name in pr["labels"]]},
+                    }
+                }
+            )
+        return {"search": {"issueCount": len(numbers), "pageInfo": page_info, "edges": edges}}
+
+    def history_page(self, variables):
+        page, page_info = self._page(self.history, variables.get("hash"))
+        history = {"pageInfo": page_info, "edges": [{"node": self._commit_node(commit)} for commit in page]}
+        return {"repository": {"ref": {"target": {"history": history}}}}
+
+    def lookup(self, query):
+        repository = {}
+        for alias, oid in OBJECT_FIELD.findall(query):
+            commit = self._commits.get(oid)
+            repository[alias] = self._commit_node(commit) if commit else None
+        return {"repository": repository}
+
+    def pull_request(self, query, variables):
+        if "commits(" in query:
+            pr = self.prs.get(variables["number"])
+            if pr is None:
+                return {"repository": {"pullRequest": None}}
+            return {"repository": {"pullRequest": {"commits": self._pr_commits(pr, variables.get("after"))}}}
+
+        # Any other PR is the backport PR, with the body backport.py gives it.
+        backported = ",".join(str(number) for number, pr in sorted(self.prs.items()) if "backported" in pr["labels"])
+        return {"repository": {"pullRequest": {"body": f"<!-- Backported: {backported} -->"}}}
+
+    def pull_requests(self, query):
+        repository = {}
+        for alias, _, number in PULL_REQUEST_FIELD.findall(query):
+            pr = self.prs.get(int(number))
+            repository[alias] = None
+            if pr is not None:
+                repository[alias] = {
+                    "number": int(number),
+                    "labels": {"edges": [{"node": {"name": label}} for label in pr["labels"]]},
+                    "closingIssuesReferences": {"edges": [{"node": {"number": issue}} for issue in pr["issues"]]},
+                }
+        return {"repository": repository}
+
+    def label_ids(self, query):
+        repository = {"requested": {"id": "label-requested"}, "backported": {"id": "label-backported"}}
+        for alias, _, number in PULL_REQUEST_FIELD.findall(query):
+            repository[alias] = {"id": f"pr-{number}"} if int(number) in self.prs else None
+        return {"repository": repository}
+
+    def graphql(self, query, variables):
+        if query.lstrip().startswith("mutation"):
+            return {alias: {"clientMutationId": None} for alias in MUTATION_FIELD.findall(query)}
+        if "requested: label(" in query:
+            return self.label_ids(query)
+        if "search(" in query:
+            return self.search(variables)
+        if "history(" in query:
+            return self.history_page(variables)
+        if "object(oid:" in query:
+            return self.lookup(query)
+        if "pullRequest(number: $number)" in query:
+            return self.pull_request(query, variables)
+        if PULL_REQUEST_FIELD.search(query):
+            return self.pull_requests(query)
+        return None
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+
+        server = self.server
+        time.sleep(server.latency)
+        headers, exhausted = server.take_rate_limit()
+        if exhausted:
+            self._send(403, {"message": "API rate limit exceeded"}, headers)
+            return
+
+        if self.path != "/graphql":
+            # Relabeling over REST; the labels themselves don't matter here.
+            self._send(200, [], headers)
+            return
+
+        request = json.loads(body)
+        data = server.replay.graphql(request["query"], request.get("variables") or {})
+        if data is None:
+            self._send(200, {"errors": [{"message": "unknown query"}]}, headers)
+        else:
+            self._send(200, {"data": data}, headers)
+
+    do_POST = _handle
+    do_DELETE = _handle
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, replay, latency=0, rate_limit=5000, window=RATE_LIMIT_WINDOW):
+        super().__init__(address, Handler)
+        self.replay = replay
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.requests = 0
+        self._remaining = rate_limit
+        self._reset = time.time() + window
+        self._lock = threading.Lock()
+
+    def take_rate_limit(self):
+        # Returns the rate limit headers, and whether the rate limit is exhausted.
+        with self._lock:
+            self.requests += 1
+            if time.time() >= self._reset:
+                self._remaining = self.rate_limit
+                self._reset = time.time() + self.window
+
+            exhausted = self._remaining <= 0
+            if not exhausted:
+                self._remaining -= 1
+            headers = {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(self._remaining),
+                "X-RateLimit-Used": str(self.rate_limit - self._remaining),
+                "X-RateLimit-Reset": str(int(self._reset)),
+            }
+            return headers, exhausted
+
+
+def start_server(metadata, port=0, latency=0, page_size=100, rate_limit=5000, window=RATE_LIMIT_WINDOW):
+    # Serve in a background thread; returns the server, and its URL.
+    server = Server(("127.0.0.1", port), Replay(metadata, page_size), latency, rate_limit, window)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Replay the GitHub API for a repository made by make_repo.py")
+    parser.add_argument("metadata", help="the github.json written by make_repo.py")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: 8080)")
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before every answer (default: 0)")
+    parser.add_argument("--page-size", type=int, default=100, help="nodes per page of a connection (default: 100)")
+    parser.add_argument(
+        "--rate-limit", type=int, default=5000, help="requests per window before refusing them (default: 5000)"
+    )
+    parser.add_argument(
+        "--rate-limit-window",
+        type=int,
+        default=RATE_LIMIT_WINDOW,
+        help=f"seconds before the rate limit resets (default: {RATE_LIMIT_WINDOW})",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    with open(args.metadata) as fp:
+        metadata = json.load(fp)
+
+    replay = Replay(metadata, args.page_size)
+    server = Server(("127.0.0.1", args.port), replay, args.latency, args.rate_limit, args.rate_limit_window)
+    print(f"Listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
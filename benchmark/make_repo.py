@@ -0,0 +1,284 @@
+"""
+Build a synthetic OpenTTD-like repository to benchmark the scripts with.
+
+Execute with:
+
+$ python3 benchmark/make_repo.py benchmark-repo --commits 2000 --languages 70 --strings 20000
+
+This creates in the given folder:
+
+- upstream.git: the "upstream" repository, with a "master" and a
+  "release/13" branch, and a "benchmark-base" tag where they split.
+- origin.git: an empty "origin" repository to push to.
+- work: a checkout with both as remotes; the scripts are run from here.
+- github.json: what GitHub knows about the commits and PRs; this is what
+  github_server.py replays.
+- settings.json: the settings it was made with. A folder that isn't empty
+  is only removed when it has this file, so it was made here before.
+
+Every commit on master is a merged PR. Some PRs have several (rebased)
+commits, some are fixes that close issues, and some are labeled "backport
+requested" or "backported" (and are then already cherry-picked to the release
+branch). Every few commits the translators update some languages, and every
+so often english.txt changes.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+RELEASE = "13"
+BASE_TAG = "benchmark-base"
+# Commit times start here, and go up by COMMIT_INTERVAL seconds per commit.
+START_TIME = 1700000000
+COMMIT_INTERVAL = 600
+# Written last; marks a folder as made by make_repo().
+SETTINGS_FILENAME = "settings.json"
+
+TYPES = ["Feature", "Add", "Change", "Fix", "Fix", "Fix", "Remove", "Codechange", "Codechange", "Doc"]
+WORDS = "train road tram ship aircraft station depot signal bridge tunnel town industry cargo company".split()
+
+
+def language_paths(count):
+    # english.txt, and count - 1 translations; every tenth is unfinished.
+    paths = ["src/lang/english.txt"]
+    for i in range(1, count):
+        folder = "src/lang/unfinished" if i % 10 == 0 else "src/lang"
+        paths.append(f"{folder}/language{i:02d}.txt")
+    return paths
+
+
+class Language:
+    # The strings of a language file, to change and write out.
+
+    def __init__(self, path, strings):
+        self.path = path
+        self.name = os.path.basename(path)[: -len(".txt")]
+        self.versions = [0] * strings
+
+    def content(self):
+        lines = [f"##name {self.name}\n", f"##ownname {self.name.capitalize()}\n", "\n"]
+        for i, version in enumerate(self.versions):
+            if i % 500 == 0:
+                lines.append(f"\n# Section {i // 500}\n")
+            lines.append(f"STR_{i:05d}_{WORDS[i % len(WORDS)].upper()} :{self.name} text {i} version {version}\n")
+        return "".join(lines).encode()
+
+
+class FastImport:
+    # Writes a "git fast-import" stream; every commit gets a mark.
+
+    def __init__(self, git_dir, marks_file):
+        self._process = subprocess.Popen(
+            ["git", "--git-dir", git_dir, "fast-import", "--quiet", f"--export-marks={marks_file}"],
+            stdin=subprocess.PIPE,
+        )
+        self._marks = 0
+        # The time of the last commit.
+        self.time = START_TIME
+
+    def _data(self, data):
+        self._process.stdin.write(f"data {len(data)}\n".encode() + data + b"\n")
+
+    def commit(self, branch, message, files, author=("Benchmark", "benchmark@example.org"), parent=None):
+        self._marks += 1
+        self.time += COMMIT_INTERVAL
+        identity = f"{author[0]} <{author[1]}> {self.time} +0000"
+
+        stream = self._process.stdin
+        stream.write(f"commit refs/heads/{branch}\nmark :{self._marks}\n".encode())
+        stream.write(f"author {identity}\ncommitter {identity}\n".encode())
+        self._data(message.encode())
+        if parent is not None:
+            stream.write(f"from :{parent}\n".encode())
+        for path, content in files.items():
+            stream.write(f"M 100644 inline {path}\n".encode())
+            self._data(content)
+        stream.write(b"\n")
+        return self._marks
+
+    def reset(self, ref, mark):
+        # Point ref (a full name, like "refs/tags/...") to the commit.
+        self._process.stdin.write(f"reset {ref}\nfrom :{mark}\n\n".encode())
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise subprocess.CalledProcessError(self._process.returncode, self._process.args)
+
+
+def make_repo(folder, commits=2000, languages=70, strings=20000, backport_prs=100, seed=1):
+    # Returns the metadata that is also written to github.json. Raises
+    # FileExistsError if the folder isn't empty and wasn't made here before.
+    random_ = random.Random(seed)
+    if os.path.exists(folder) and os.listdir(folder):
+        if not os.path.exists(os.path.join(folder, SETTINGS_FILENAME)):
+            raise FileExistsError(f"{folder} is not empty, and was not made by make_repo.py; not removing it")
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok=True)
+
+    upstream = os.path.join(folder, "upstream.git")
+    subprocess.run(["git", "init", "-q", "--bare", upstream], check=True)
+    subprocess.run(["git", "init", "-q", "--bare", os.path.join(folder, "origin.git")], check=True)
+
+    marks_file = os.path.join(folder, "marks")
+    fast_import = FastImport(upstream, marks_file)
+
+    langs = [Language(path, strings) for path in language_paths(languages)]
+    files = {lang.path: lang.content() for lang in langs}
+    files["src/main.cpp"] = b"int main() { return 0; }\n"
+    base = fast_import.commit("master", "Feature: the game", files)
+    fast_import.reset(f"refs/tags/{BASE_TAG}", base)
+
+    history = []  # (mark, pr) of every commit on master, oldest first.
+    prs = {}
+    parent = base
+    number = 100
+    issue = 5000
+    while len(history) < commits:
+        number += 1
+
+        # Every few commits, the translators update some languages.
+        if number % 25 == 0:
+            changed = {}
+            for lang in random_.sample(langs[1:], min(3, len(langs) - 1)):
+                for i in random_.sample(range(strings), min(50, strings)):
+                    lang.versions[i] += 1
+                changed[lang.path] = lang.content()
+            mark = fast_import.commit(
+                "master",
+                "Update: Translations from eints",
+                changed,
+                author=("translators", "translators@openttd.org"),
+                parent=parent,
+            )
+            history.append((mark, None))
+            parent = mark
+            continue
+
+        commit_type = TYPES[number % len(TYPES)]
+        title = f"{commit_type}: {WORDS[number % len(WORDS)]} change {number}"
+        pr = {"number": number, "title": title, "labels": [], "issues": [], "commits": []}
+        if commit_type == "Fix" and number % 2 == 0:
+            issue += 1
+            pr["issues"].append(issue)
+            if number % 4 == 0:
+                title = f"Fix #{issue}: {WORDS[number % len(WORDS)]} change {number}"
+                pr["title"] = title
+
+        # Some PRs are rebased instead of squashed; their commits don't
+        # mention the PR.
+        count = 3 if number % 7 == 0 else 1
+        for i in range(count):
+            if count == 1:
+                message = f"{title} (#{number})"
+            else:
+                message = f"{commit_type}: part {i + 1} of {WORDS[number % len(WORDS)]} change {number}"
+            changed = {f"src/module{number % 50}/pr{number}_{i}.cpp": f"// PR {number}, commit {i}\n".encode()}
+
+            # Now and then english.txt changes with it.
+            if i == 0 and number % 100 == 0:
+                english = langs[0]
+                for string in random_.sample(range(strings), min(20, strings)):
+                    english.versions[string] += 1
+                changed[english.path] = english.content()
+
+            parent = fast_import.commit("master", message, changed, parent=parent)
+            history.append((parent, number))
+            pr["commits"].append(message)
+        pr["mark"] = parent
+        pr["mergedAt"] = datetime.datetime.utcfromtimestamp(fast_import.time).strftime("%Y-%m-%dT%H:%M:%SZ")
+        prs[number] = pr
+
+    # The last backport_prs PRs that don't touch english.txt are requested
+    # for backport; every fifth of them was already backported.
+    candidates = [pr for pr in prs.values() if pr["number"] % 100 != 0][-backport_prs:] if backport_prs else []
+    release_parent = base
+    for i, pr in enumerate(candidates):
+        if i % 5 == 4:
+            pr["labels"].append("backported")
+            for j, message in enumerate(pr["commits"]):
+                path = f"src/module{pr['number'] % 50}/pr{pr['number']}_{j}.cpp"
+                changed = {path: f"// PR {pr['number']}, commit {j}\n".encode()}
+                release_parent = fast_import.commit(f"release/{RELEASE}", message, changed, parent=release_parent)
+        else:
+            pr["labels"].append("backport requested")
+    if release_parent == base:
+        fast_import.reset(f"refs/heads/release/{RELEASE}", base)
+
+    fast_import.close()
+
+    oids = {}
+    with open(marks_file) as fp:
+        for line in fp:
+            mark, oid = line.split()
+            oids[int(mark[1:])] = oid
+    os.unlink(marks_file)
+
+    metadata = {
+        "history": [{"oid": oids[mark], "pr": pr} for mark, pr in reversed(history)],
+        "prs": {},
+    }
+    for pr in prs.values():
+        metadata["prs"][str(pr["number"])] = {
+            "title": pr["title"],
+            "labels": pr["labels"],
+            "issues": pr["issues"],
+            "commits": pr["commits"],
+            "mergeCommit": oids[pr["mark"]],
+            "mergedAt": pr["mergedAt"],
+        }
+    with open(os.path.join(folder, "github.json"), "w") as fp:
+        json.dump(metadata, fp)
+
+    work = os.path.join(folder, "work")
+    subprocess.run(["git", "clone", "-q", "--origin", "upstream", upstream, work], check=True)
+    for command in (
+        ["remote", "add", "origin", os.path.abspath(os.path.join(folder, "origin.git"))],
+        ["config", "user.name", "Benchmark"],
+        ["config", "user.email", "benchmark@example.org"],
+    ):
+        subprocess.run(["git", "-C", work, *command], check=True)
+
+    settings = {
+        "commits": commits,
+        "languages": languages,
+        "strings": strings,
+        "backport_prs": backport_prs,
+        "seed": seed,
+    }
+    with open(os.path.join(folder, SETTINGS_FILENAME), "w") as fp:
+        json.dump(settings, fp)
+    return metadata
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Build a synthetic repository to benchmark the scripts with")
+    parser.add_argument("folder", help="where to create the repository (removed first if it was created here before)")
+    parser.add_argument("--commits", type=int, default=2000, help="how many commits on master (default: 2000)")
+    parser.add_argument("--languages", type=int, default=70, help="how many language files (default: 70)")
+    parser.add_argument("--strings", type=int, default=20000, help="how many strings per language (default: 20000)")
+    parser.add_argument(
+        "--backport-prs", type=int, default=100, help="how many PRs are labeled for backport (default: 100)"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random changes (default: 1)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    try:
+        metadata = make_repo(args.folder, args.commits, args.languages, args.strings, args.backport_prs, args.seed)
+    except FileExistsError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Created {len(metadata['history'])} commits and {len(metadata['prs'])} PRs in {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Time backport.py, backport-languages.py and changelog.py end to end, against a
+synthetic repository (make_repo.py) and a local stand-in for the GitHub API
+(github_server.py). Nothing talks to GitHub.
+
+Execute with:
+
+$ python3 benchmark/run.py --commits 5000 --latency 0.05
+
+The repository is built in benchmark-repo/ (see --folder), and reused by
+later runs with the same size; it is built again when the size changes. The
+output of every script is written to the "logs" folder in there.
+
+Use --only to run some of the benchmarks, and --profile to run the scripts
+with --profile (where supported); the traces end up in the "logs" folder too.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import github_server
+import make_repo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# The scripts, and the shared modules they need next to them.
+SCRIPTS = [
+    "backport/backport.py",
+    "backport/backport-languages.py",
+    "changelog/changelog.py",
+] + sorted(os.path.relpath(path, ROOT) for path in glob.glob(os.path.join(ROOT, "common", "*.py")))
+
+# Files the scripts leave behind, to remove before every benchmark.
+STATE_FILES = [
+    ".changelog-index.sqlite",
+    ".github-api-cache.sqlite",
+    ".backport-resume",
+    ".backport-checkpoint",
+    ".backport-patch-ids",
+    ".backport-applied",
+    ".backport-languages-cache",
+]
+
+
+def git(work, *command):
+    subprocess.run(["git", "-C", work, *command], check=True, capture_output=True)
+
+
+def clean(work, keep=()):
+    # Forget what earlier runs left behind, and start from master.
+    for filename in STATE_FILES:
+        path = os.path.join(work, filename)
+        if filename in keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+    git(work, "reset", "-q", "--hard")
+    git(work, "checkout", "-q", "-f", "master")
+    # These branches might not exist (yet).
+    branches = ["release-backport", "changelog"] + [
+        f"release-languages-{name}" for name in (make_repo.RELEASE, make_repo.BASE_TAG)
+    ]
+    subprocess.run(["git", "-C", work, "branch", "-q", "-D", *branches], capture_output=True)
+
+
+def release_checkout(work):
+    # backport-languages.py works on a checkout of the release branch.
+    clean(work)
+    git(work, "checkout", "-q", "-B", "release-backport", f"upstream/release/{make_repo.RELEASE}")
+
+
+# (name, setup, arguments); the arguments are to run with the script (the first).
+BENCHMARKS = [
+    ("changelog", clean, ["changelog.py", make_repo.BASE_TAG]),
+    # Keeps the responses of the one before.
+    (
+        "changelog-cached",
+        lambda work: clean(work, keep=[".github-api-cache.sqlite"]),
+        ["changelog.py", make_repo.BASE_TAG],
+    ),
+    (
+        "changelog-warm",
+        lambda work: clean(work, keep=[".changelog-index.sqlite"]),
+        ["changelog.py", make_repo.BASE_TAG],
+    ),
+    ("changelog-walk-history", clean, ["changelog.py", "--walk-history", make_repo.BASE_TAG]),
+    ("changelog-offline", clean, ["changelog.py", "--offline", make_repo.BASE_TAG]),
+    ("backport-plan", clean, ["backport.py", "--plan"]),
+    ("backport", clean, ["backport.py", "--dont-push"]),
+    ("backport-mark-done", clean, ["backport.py", "--mark-done", "1"]),
+    ("languages", release_checkout, ["backport-languages.py"]),
+    ("languages-objects", release_checkout, ["backport-languages.py", "--objects"]),
+    # The base stands in for a second, older, release branch.
+    (
+        "languages-releases",
+        clean,
+        [
+            "backport-languages.py",
+            "--release",
+            f"upstream/release/{make_repo.RELEASE}",
+            "--release",
+            make_repo.BASE_TAG,
+        ],
+    ),
+]
+PROFILED = ("changelog.py", "backport.py")
+
+
+def prepare(folder, size):
+    # Build the repository, unless it was built before with the same size.
+    settings_file = os.path.join(folder, make_repo.SETTINGS_FILENAME)
+    if os.path.exists(settings_file):
+        with open(settings_file) as fp:
+            if json.load(fp) == size:
+                print(f"Reusing the repository in {folder}")
+                with open(os.path.join(folder, "github.json")) as fp:
+                    return json.load(fp)
+
+    print(f"Building a repository with {size['commits']} commits in {folder} ...")
+    start = time.monotonic()
+    try:
+        metadata = make_repo.make_repo(folder, **size)
+    except FileExistsError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Built in {time.monotonic() - start:.1f}s")
+    return metadata
+
+
+def install_scripts(work):
+    # Like in a real checkout, the scripts live in .github/.
+    target = os.path.join(work, ".github")
+    os.makedirs(target, exist_ok=True)
+    for script in SCRIPTS:
+        shutil.copy(os.path.join(ROOT, script), target)
+
+
+def run_benchmark(work, logs, server, url, name, setup, arguments, profile):
+    setup(work)
+
+    script = arguments[0]
+    command = [sys.executable, os.path.join(".github", script)] + arguments[1:]
+    if profile and script in PROFILED:
+        command.append("--profile")
+    env = dict(
+        os.environ, GITHUB_API_URL=url, GITHUB_TOKEN="benchmark", GITHUB_USERNAME="benchmark", PYTHONUNBUFFERED="1"
+    )
+
+    requests = server.requests
+    start = time.monotonic()
+    with open(os.path.join(logs, f"{name}.log"), "w") as fp:
+        res = subprocess.run(command, cwd=work, env=env, stdout=fp, stderr=subprocess.STDOUT)
+    elapsed = time.monotonic() - start
+
+    if profile and script in PROFILED:
+        trace = os.path.join(work, script.replace(".py", "-profile.json"))
+        if os.path.exists(trace):
+            os.replace(trace, os.path.join(logs, f"{name}-profile.json"))
+
+    return elapsed, server.requests - requests, res.returncode
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Benchmark the scripts against a synthetic repository")
+    parser.add_argument("--folder", default="benchmark-repo", help="where to build the repository")
+    parser.add_argument("--commits", type=int, default=2000, help="how many commits on master (default: 2000)")
+    parser.add_argument("--languages", type=int, default=70, help="how many language files (default: 70)")
+    parser.add_argument("--strings", type=int, default=20000, help="how many strings per language (default: 20000)")
+    parser.add_argument(
+        "--backport-prs", type=int, default=100, help="how many PRs are labeled for backport (default: 100)"
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per API request (default: 0.05)")
+    parser.add_argument("--page-size", type=int, default=100, help="nodes per page of a connection (default: 100)")
+    parser.add_argument("--rate-limit", type=int, default=5000, help="API requests per window (default: 5000)")
+    parser.add_argument(
+        "--rate-limit-window",
+        type=int,
+        default=github_server.RATE_LIMIT_WINDOW,
+        help=f"seconds before the rate limit resets (default: {github_server.RATE_LIMIT_WINDOW})",
+    )
+    parser.add_argument(
+        "--only", action="append", choices=[name for name, _, _ in BENCHMARKS], help="only run this benchmark"
+    )
+    parser.add_argument("--profile", action="store_true", help="run the scripts with --profile, where supported")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    size = {
+        "commits": args.commits,
+        "languages": args.languages,
+        "strings": args.strings,
+        "backport_prs": args.backport_prs,
+        "seed": 1,
+    }
+    metadata = prepare(args.folder, size)
+
+    work = os.path.join(args.folder, "work")
+    logs = os.path.join(args.folder, "logs")
+    os.makedirs(logs, exist_ok=True)
+    install_scripts(work)
+
+    failed = False
+    print(f"{'benchmark':<25} {'time (s)':>10} {'requests':>10}")
+    for name, setup, arguments in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+
+        # Every benchmark starts with a fresh rate limit.
+        server, url = github_server.start_server(
+            metadata, 0, args.latency, args.page_size, args.rate_limit, args.rate_limit_window
+        )
+        elapsed, requests, returncode = run_benchmark(work, logs, server, url, name, setup, arguments, args.profile)
+        server.shutdown()
+        server.server_close()
+
+        status = "" if returncode == 0 else f"  FAILED (exit code {returncode}; see {logs}/{name}.log)"
+        failed = failed or returncode != 0
+        print(f"{name:<25} {elapsed:>10.2f} {requests:>10}{status}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 """
 Put this file in a master checkout under .github/.
+It should be next to github_api.py, git_session.py and tracing.py.
 
 This assumes your git "origin" points to your fork, and "upstream" to upstream.
 This script will overwrite the branch "changelog".
@@ -11,18 +12,93 @@ Execute with:
 
 $ export GITHUB_TOKEN=ghp_XXX
 $ python3 .github/changelog.py <last-commit-of-previous-release>
+
+PR numbers are taken from the "(#NNNN)" at the end of commit messages, and
+commits found on an upstream release branch are considered backported. Only
+commits without a PR number, and fixes (to find the issues they close), are
+looked up on GitHub. A backport that needed its conflicts resolved isn't found
+on the release branch, so for the PRs of all other commits the labels are
+looked up too (many PRs per query), to find the ones labeled "backported".
+With --offline nothing is looked up, and no GITHUB_TOKEN is needed.
+
+What is fetched from GitHub is stored in .changelog-index.sqlite, and reused
+by later runs; only commits not in there yet are fetched. Use --refresh to
+fetch all commits in the range again (for example, after PRs got labeled as
+backported); this also skips the response cache of github_api.py.
+
+To create several changelogs in one go (for example, a major release and a
+point release off its release branch), give the ranges with --range:
+
+$ python3 .github/changelog.py --range <base>..upstream/master --range <base>..upstream/release/14
+
+Commits shared by the ranges are only looked up once.
+
+With --profile, where the time goes (GitHub, git, and the phases of the run)
+is written to changelog-profile.json, in the Chrome trace-event format.
 """
 
+import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import json
 import os
-import subprocess
+import re
+import sqlite3
 import sys
+import threading
+
+import git_session
+import github_api
+import tracing
 
 BEARER_TOKEN = os.getenv("GITHUB_TOKEN")
 
-if not BEARER_TOKEN:
-    print("Please set the GITHUB_TOKEN environment variable.")
-    sys.exit(1)
+# Where commits and their PRs, once fetched, are stored.
+INDEX_FILENAME = ".changelog-index.sqlite"
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS commits (oid TEXT PRIMARY KEY, pr INTEGER);
+CREATE TABLE IF NOT EXISTS pull_requests (
+    number INTEGER PRIMARY KEY,
+    labels TEXT NOT NULL,
+    issues TEXT NOT NULL
+);
+"""
+# Where the trace of --profile is written.
+PROFILE_FILENAME = "changelog-profile.json"
+# How many commits to look up in the index in a single query.
+INDEX_BATCH_SIZE = 500
+# How many commits to look up on GitHub in a single query.
+LOOKUP_BATCH_SIZE = 100
+# How many of those queries to have in flight at the same time.
+LOOKUP_WORKERS = 4
+
+# Branches backports end up on.
+RELEASE_BRANCHES = "refs/remotes/upstream/release/*"
+
+PR_SUFFIX = re.compile(r"\(#(\d+)\)$")
+# What is considered a reference to a commit: an abbreviated hash.
+COMMIT_REFERENCE = re.compile(r"[0-9a-f]{6,40}")
+
+# The grammar of a commit message: "Type[ subject]: [Component] text[.][ (#NNNN)]".
+COMMIT_MESSAGE = re.compile(
+    r"\s*(?P<type>[^\s:]+)"
+    r"(?:\s+(?P<subject>[^:]*?))?\s*:\s*"
+    r"(?:\[(?P<component>[^\]]*)\]\s*)?"
+    r"(?P<text>\S.*?)[\s.]*"
+    r"(?:\(#(?P<pr>\d+)\))?\s*"
+)
+# Commits that don't change functionality, or are related to the CI.
+IGNORED_MESSAGE = re.compile(
+    r"^(?:Codechange|Codefix|Doc|Update|Upgrade|Cleanup|Prepare|Revert)|\[(?:CI|Dependabot|DorpsGek)\]"
+)
+IGNORED_EMAILS = ("translators@openttd.org",)
+
+# A parsed commit message. "tickets" and "references" are the issues and
+# commits a fix mentions in its subject; "text" is the capitalized message,
+# and "pr" the PR number at the end of the message (or None).
+CommitMessage = collections.namedtuple("CommitMessage", "type tickets references text pr")
 
 PRIORITY = {
     "Feature": 1,
@@ -40,6 +116,7 @@ query ($hash: String) {
         ... on Commit {
           history(first: 100, after: $hash) {
             pageInfo{
+              hasNextPage
               endCursor
             }
             edges {
@@ -77,202 +154,621 @@ query ($hash: String) {
 
 """
 
+commit_lookup_fields = """
+... on Commit {
+  oid
+  associatedPullRequests(first: 1) {
+    edges {
+      node {
+        number
+        labels(first: 10) {
+          edges {
+            node {
+              name
+            }
+          }
+        }
+        closingIssuesReferences(first: 10) {
+          edges {
+            node {
+              number
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+pull_request_lookup_fields = """
+number
+labels(first: 10) {
+  edges {
+    node {
+      name
+    }
+  }
+}
+closingIssuesReferences(first: 10) {
+  edges {
+    node {
+      number
+    }
+  }
+}
+"""
+
 
 def do_query(query, variables):
-    query = query.replace("\n", "").replace("\\", "\\\\").replace('"', '\\"')
-    variables = json.dumps(variables).replace("\\", "\\\\").replace('"', '\\"')
-    res = subprocess.run(
-        [
-            "curl",
-            "--fail",
-            "-H",
-            f"Authorization: bearer {BEARER_TOKEN}",
-            "-X",
-            "POST",
-            "-d",
-            f'{{"query": "{query}", "variables": "{variables}"}}',
-            "https://api.github.com/graphql",
-        ],
-        capture_output=True,
-    )
-    if res.returncode != 0:
-        return None
-    return json.loads(res.stdout)
+    # What the changelog looks up may be a few minutes old; the index keeps
+    # it much longer anyway.
+    return github_api.do_query(query, variables, reuse=True)
 
 
-def do_command(command):
-    return subprocess.run(command, capture_output=True)
+class CommitIndex:
+    # A sorted list of commit hashes, to check whether a (possibly abbreviated)
+    # hash refers to one of them with a binary search.
 
+    def __init__(self, oids):
+        self._oids = sorted(oids)
 
-def main():
-    last_commit = sys.argv[1]
+    def __contains__(self, reference):
+        if not COMMIT_REFERENCE.fullmatch(reference):
+            return False
+        i = bisect.bisect_left(self._oids, reference)
+        return i < len(self._oids) and self._oids[i].startswith(reference)
+
+
+def is_ignored(email, message):
+    return email in IGNORED_EMAILS or IGNORED_MESSAGE.search(message) is not None
 
-    do_command(["git", "fetch", "upstream"])
-    do_command(["git", "checkout", "upstream/master", "-B", "changelog"])
 
-    commit_list = do_command(["git", "log", "--pretty=format:%ce|%H|%s", f"{last_commit}..HEAD"])
-    commits = commit_list.stdout.decode().splitlines()
+def parse_commit_message(message):
+    # Returns the CommitMessage of a commit message, or None if it isn't in
+    # the "Type: text" format (or the type is not one for the changelog).
+    match = COMMIT_MESSAGE.fullmatch(message)
+    if match is None or match["type"] not in PRIORITY:
+        return None
+
+    tickets = []
+    references = []
+    # Only fixes mention what they fix.
+    if match["subject"] and match["type"] == "Fix":
+        for sub in match["subject"].split(","):
+            sub = sub.strip()
+            if sub.startswith("#"):
+                tickets.append(sub)
+            elif sub:
+                references.append(sub)
+
+    text = match["text"]
+    text = text[0].upper() + text[1:]
+    if match["component"] is not None:
+        text = f"[{match['component']}] {text}"
+
+    pr = int(match["pr"]) if match["pr"] else None
+    return CommitMessage(match["type"], tickets, references, text, pr)
+
+
+def find_backported_commits(bases, oids):
+    # Returns (backported, release): the commits of "oids" that were
+    # backported to a release branch, and the commits of "oids" that are on a
+    # release branch themselves (and so are backports, not backported). A
+    # backport can't be older than the oldest base, so only release commits
+    # since then are looked at.
+    # A match is a commit with the same patch-id; these are taken with the
+    # context of the diff, so a commit doing the same in another place of a
+    # file doesn't count as a backport.
+    since = min(int(git_session.read_commit(base).committer.date.split()[0]) for base in bases)
+    release = git_session.patch_ids([f"--glob={RELEASE_BRANCHES}", "^upstream/master", f"--max-age={since}"])
+    released = set(release.values())
+    if not released:
+        return set(), set()
+
+    patch_ids = git_session.patch_ids([], revisions=oids)
+    backported = {commit for commit, patch_id in patch_ids.items() if patch_id in released and commit not in release}
+    return backported, set(oids) & release.keys()
+
+
+def open_index():
+    # The index maps commits to their PR (NULL if they have none), and PRs to
+    # their labels and the issues they close.
+    db = sqlite3.connect(INDEX_FILENAME)
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+
+def pr_info(node):
+    # Returns the PR number (or None), labels and closing issues of a commit node.
+    if not node["associatedPullRequests"]["edges"]:
+        return None, [], []
+
+    return pull_request_info(node["associatedPullRequests"]["edges"][0]["node"])
+
+
+def pull_request_info(pr):
+    # Returns the number, labels and closing issues of a PR node.
+    labels = [label["node"]["name"] for label in pr["labels"]["edges"]]
+    issues = [issue["node"]["number"] for issue in pr["closingIssuesReferences"]["edges"]]
+    return pr["number"], labels, issues
+
+
+def index_store(db, nodes):
+    for node in nodes:
+        number, labels, issues = pr_info(node)
+        db.execute("INSERT OR REPLACE INTO commits VALUES (?, ?)", (node["oid"], number))
+        if number is not None:
+            db.execute(
+                "INSERT OR REPLACE INTO pull_requests VALUES (?, ?, ?)",
+                (number, json.dumps(labels), json.dumps(issues)),
+            )
+    db.commit()
+
 
+def index_store_prs(db, prs):
+    # "prs" is a list of (number, labels, closing issues).
+    for number, labels, issues in prs:
+        db.execute(
+            "INSERT OR REPLACE INTO pull_requests VALUES (?, ?, ?)", (number, json.dumps(labels), json.dumps(issues))
+        )
+    db.commit()
+
+
+def index_load(db, oids):
+    # Returns commit_to_pr, backported and issues for the given commits, and
+    # the set of commits that are not in the index yet.
     commit_to_pr = {}
+    missing = set(oids)
+    for start in range(0, len(oids), INDEX_BATCH_SIZE):
+        batch = oids[start : start + INDEX_BATCH_SIZE]
+        rows = db.execute(f"SELECT oid, pr FROM commits WHERE oid IN ({','.join('?' * len(batch))})", batch)
+        for oid, pr in rows:
+            missing.discard(oid)
+            if pr is not None:
+                commit_to_pr[oid] = pr
+
+    backported, issues, _ = index_load_prs(db, set(commit_to_pr.values()))
+    return commit_to_pr, backported, issues, missing
+
+
+def index_load_prs(db, numbers):
+    # Returns backported and issues for the given PRs, and the set of PRs
+    # that are not in the index yet.
     backported = set()
-    commits_seen = set()
     issues = {}
+    missing = set(numbers)
+    prs = sorted(numbers)
+    for start in range(0, len(prs), INDEX_BATCH_SIZE):
+        batch = prs[start : start + INDEX_BATCH_SIZE]
+        rows = db.execute(
+            f"SELECT number, labels, issues FROM pull_requests WHERE number IN ({','.join('?' * len(batch))})", batch
+        )
+        for number, labels, closing_issues in rows:
+            missing.discard(number)
+            # Check if this PR was backported.
+            if "backported" in json.loads(labels):
+                backported.add(number)
+            # Track which issues were closed because of this PR.
+            if json.loads(closing_issues):
+                issues[number] = json.loads(closing_issues)
+
+    return backported, issues, missing
+
+
+def build_commit_lookup_query(oids):
+    # One aliased object(oid:) field per commit.
+    fields = "".join(f'c{i}: object(oid: "{oid}") {{{commit_lookup_fields}}}' for i, oid in enumerate(oids))
+    return f'query {{ repository(owner: "OpenTTD", name: "OpenTTD") {{ {fields} }} }}'
+
+
+def lookup_commits(missing):
+    # Look up exactly the missing commits, in batches, with a few batches in
+    # flight at the same time. Yields the commits found, per batch.
+    print(f"Fetching {len(missing)} commits and their associated PRs ...")
+
+    oids = sorted(missing)
+    batches = [oids[start : start + LOOKUP_BATCH_SIZE] for start in range(0, len(oids), LOOKUP_BATCH_SIZE)]
+    unknown = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+        pending = set()
+        while batches or pending:
+            while batches and len(pending) < LOOKUP_WORKERS:
+                pending.add(executor.submit(do_query, build_commit_lookup_query(batches.pop(0)), {}))
+
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                res = future.result()
+                if res is None or not res.get("data") or not res["data"].get("repository"):
+                    raise github_api.QueryError("failed to look up commits")
+
+                nodes = [node for node in res["data"]["repository"].values() if node is not None]
+                unknown += len(res["data"]["repository"]) - len(nodes)
+                yield nodes
+
+    if unknown:
+        print(f"WARNING: {unknown} commits are not known to GitHub")
+
+
+def build_pull_request_lookup_query(numbers):
+    # One aliased pullRequest(number:) field per PR.
+    fields = "".join(
+        f"pr{number}: pullRequest(number: {number}) {{{pull_request_lookup_fields}}}" for number in numbers
+    )
+    return f'query {{ repository(owner: "OpenTTD", name: "OpenTTD") {{ {fields} }} }}'
+
+
+def lookup_pull_requests(numbers):
+    # Returns a list of (number, labels, closing issues) of the given PRs, in
+    # batches, with a few batches in flight at the same time. Numbers that are
+    # not a PR are returned without labels, so they are not asked for again.
+    print(f"Fetching the labels of {len(numbers)} PRs ...")
+
+    numbers = sorted(numbers)
+    batches = [numbers[start : start + LOOKUP_BATCH_SIZE] for start in range(0, len(numbers), LOOKUP_BATCH_SIZE)]
+    prs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+        queries = (build_pull_request_lookup_query(batch) for batch in batches)
+        for batch, res in zip(batches, executor.map(lambda query: do_query(query, {}), queries)):
+            if res is None or not res.get("data") or not res["data"].get("repository"):
+                raise github_api.QueryError("failed to look up PRs")
+
+            repository = res["data"]["repository"]
+            for number in batch:
+                pr = repository.get(f"pr{number}")
+                prs.append(pull_request_info(pr) if pr else (number, [], []))
+    return prs
+
+
+def fetch_missing(missing, limit):
+    # Walk the history of master on GitHub until all missing commits are seen,
+    # yielding every commit on the way, per page. Never walks further than
+    # "limit" commits, the size of the range.
+    print(f"Fetching {len(missing)} commits and their associated PRs ... this might take a while ...")
+
+    remaining = set(missing)
+    walked = 0
+    pages = github_api.paginate(
+        commit_pr_query,
+        {},
+        lambda data: data["repository"]["ref"]["target"]["history"],
+        cursor_variable="hash",
+        reuse=True,
+    )
+    for page in pages:
+        edges = page["repository"]["ref"]["target"]["history"]["edges"]
+        yield [edge["node"] for edge in edges]
+
+        for edge in edges:
+            remaining.discard(edge["node"]["oid"])
+        walked += len(edges)
+        if not remaining or walked >= limit:
+            break
+        print(f"{len(remaining)} commits left ...")
+
+
+def parse_range(value):
+    base, dots, tip = value.partition("..")
+    if not dots or not base or not tip:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a range like BASE..TIP")
+    return base, tip
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Create the changelog since the previous release")
+    parser.add_argument("last_commit", nargs="?", help="last commit of the previous release")
+    parser.add_argument(
+        "--range",
+        dest="ranges",
+        action="append",
+        default=[],
+        type=parse_range,
+        metavar="BASE..TIP",
+        help="also create the changelog of this range (can be given multiple times)",
+    )
+    parser.add_argument("--refresh", action="store_true", help="fetch all commits in the range from GitHub again")
+    parser.add_argument(
+        "--offline", action="store_true", help="don't look up anything on GitHub; use what is known locally"
+    )
+    parser.add_argument(
+        "--walk-history",
+        action="store_true",
+        help="walk the history of master on GitHub, instead of looking up the commits in the range directly",
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help=f"record where the time goes, and write that to {PROFILE_FILENAME}"
+    )
+    args = parser.parse_args()
 
-    cache_filename = f".changelog-cache-{last_commit}.{len(commits)}"
-
-    if os.path.exists(cache_filename):
-        with open(cache_filename, "r") as f:
-            data = json.loads(f.read())
-            commit_to_pr = data["commit_to_pr"]
-            backported = set(data["backported"])
-            commits_seen = set(data["commits_seen"])
-            issues = data["issues"]
-    else:
-        print("Fetching commits and their associated PRs ... this might take a while ...")
-
-        count = len(commits)
-        variables = {}
-        while count > 0:
-            print(f"{count} commits left ...")
-
-            res = do_query(commit_pr_query, variables)
-            variables["hash"] = res["data"]["repository"]["ref"]["target"]["history"]["pageInfo"]["endCursor"]
-
-            # Walk all commits.
-            for edge in res["data"]["repository"]["ref"]["target"]["history"]["edges"]:
-                count -= 1
-                if count == 0:
-                    break
-                if not edge["node"]["associatedPullRequests"]["edges"]:
-                    continue
-
-                pr = edge["node"]["associatedPullRequests"]["edges"][0]["node"]
-
-                # Links the commit to a PR.
-                commit_to_pr[edge["node"]["oid"]] = pr["number"]
-                # Link the hashes between 6 and 10 in size to the list of "seen commits".
-                for i in range(6, 10):
-                    commits_seen.add(edge["node"]["oid"][0:i])
-
-                # Check if this PR was backported.
-                for label in pr["labels"]["edges"]:
-                    if label["node"]["name"] == "backported":
-                        backported.add(pr["number"])
-
-                # Track which issues were closed because of this PR.
-                if pr["closingIssuesReferences"]["edges"]:
-                    issues[pr["number"]] = []
-                    for issue in pr["closingIssuesReferences"]["edges"]:
-                        issues[pr["number"]].append(issue["node"]["number"])
-
-        with open(cache_filename, "w") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "commit_to_pr": commit_to_pr,
-                        "backported": list(backported),
-                        "commits_seen": list(commits_seen),
-                        "issues": issues,
-                    }
-                )
-            )
-
-    messages = []
+    if args.last_commit:
+        args.ranges.insert(0, (args.last_commit, "HEAD"))
+    if not args.ranges:
+        parser.error("either last_commit or --range is required")
+    return args
 
-    for commit in commit_list.stdout.decode().splitlines():
-        (email, hash, message) = commit.split("|", 2)
 
-        if email in ("translators@openttd.org",):
-            continue
+def classify_commit(hash, parsed, pr, issues, commits_seen):
+    # Returns (priority, pr, changelog entry) for a commit, given its
+    # CommitMessage, or None if it shouldn't be in the changelog.
 
-        # Ignore all commit messages that don't change functionality.
-        if message.startswith(("Codechange", "Codefix", "Doc", "Update", "Upgrade", "Cleanup", "Prepare", "Revert")):
-            continue
-        # Ignore everything related to the CI.
-        if "[CI]" in message or "[Dependabot]" in message or "[DorpsGek]" in message:
-            continue
+    # If a referenced hash is in our set of commits, it is a fix for
+    # something unreleased; so don't mention it.
+    if any(reference in commits_seen for reference in parsed.references):
+        return None
+    # If we reference a ticket, that will be the subject.
+    subject = parsed.tickets[-1] if parsed.tickets else None
+
+    if parsed.type == "Fix" and issues.get(pr):
+        issue_list = issues[pr]
+
+        # Check if any of the linked issues are mentioned in the commit.
+        for issue in issue_list:
+            if subject and f"#{issue}" in subject:
+                break
+        else:
+            # The linked issue is not mentioned. Create the link.
+            issue = ", ".join([f"#{issue}" for issue in issue_list])
+
+            if subject and subject != issue:
+                print(f"WARNING: commit {hash} has a different references than the PR {pr}: '{subject}' vs '{issue}'")
+            subject = issue
+
+    message = parsed.type
+    if subject:
+        message += f" {subject}"
+    message += f": {parsed.text}"
+    if pr != -1:
+        message += f" (#{pr})"
+
+    return PRIORITY[parsed.type], int(pr), message
+
+
+async def build_changelog(db, commits, ranges, waiting_for, fetch, known, backported_commits, release_commits):
+    # Classify the commits while the missing ones are still being fetched.
+    # "fetch" is run in a thread, and yields the commit nodes it fetched;
+    # these are stored in the index and the commits that were waiting for
+    # them are classified as they come in.
+    # "commits" maps every commit to its (email, message); "ranges" is a list
+    # with the commits of every changelog to create. Returns the changelog
+    # entries of every range, and the commits whose message couldn't be
+    # parsed.
+    commit_to_pr, backported, issues = known
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    # Set when the classifying stops early; the fetch then stops too.
+    stop = threading.Event()
+
+    def produce():
+        # Always ends with None, or with whatever stopped the fetch.
+        try:
+            for nodes in fetch:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, nodes)
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+        finally:
+            if hasattr(fetch, "close"):
+                fetch.close()
+
+    producer = loop.run_in_executor(None, produce)
+
+    # Any hash in a range, of any length, is a "seen commit" for that range.
+    commits_seen = [CommitIndex(oids) for oids in ranges]
+    # For every commit, the ranges it is in, and its position in there.
+    positions = {}
+    for index, oids in enumerate(ranges):
+        for position, hash in enumerate(oids):
+            positions.setdefault(hash, []).append((index, position))
+
+    entries = [[] for _ in ranges]
+    malformed = []
+    waiting = set()
+
+    def classify(hash):
+        _, message = commits[hash]
+
+        parsed = parse_commit_message(message)
+        if parsed is None:
+            malformed.append((hash, message))
+            return
 
         pr = commit_to_pr.get(hash)
         if pr is None:
             pr = -1
 
-        # Skip everything already backported.
-        if pr in backported:
-            continue
-
-        # Remove the PR number from the commit message.
-        if message.endswith(f"(#{pr})"):
-            message = message[: -len(f"(#{pr})")]
-
-        commit_type, commit_message = message.strip().split(":", 1)
-        subject = None
-
-        # Remove trailing dots.
-        commit_message = commit_message.strip().rstrip(".")
-        commit_message = commit_message[0].upper() + commit_message[1:]
-        # If the string starts with [, capitalize the first letter after the ].
-        if commit_message.startswith("["):
-            part1, part2 = commit_message.split("]", 1)
-            part2 = part2.strip()
-            commit_message = part1 + "] " + part2[0].upper() + part2[1:]
-
-        if " " in commit_type:
-            commit_type, subject = commit_type.split(" ", 1)
-
-            if commit_type != "Fix":
-                # Remove subject if not a fix.
-                subject = None
-            else:
-                reference = False
-                ticket = None
-
-                # Check all parts of the subject for either a ticket or hash.
-                for sub in subject.split(","):
-                    sub = sub.strip()
-
-                    # If we reference a ticket, that will be the subject.
-                    if sub.startswith("#"):
-                        ticket = sub
-                        continue
-
-                    # If the hash is in our set of commits, it is a fix for
-                    # something unreleased; so don't mention it.
-                    if sub in commits_seen:
-                        reference = True
-                        break
-
-                if reference:
-                    continue
-                subject = ticket
-
-        if commit_type == "Fix" and issues.get(str(pr)):
-            issue_list = issues[str(pr)]
-
-            # Check if any of the linked issues are mentioned in the commit.
-            for issue in issue_list:
-                if subject and f"#{issue}" in subject:
-                    break
-            else:
-                # The linked issue is not mentioned. Create the link.
-                issue = ", ".join([f"#{issue}" for issue in issue_list])
-
-                if subject and subject != issue:
-                    print(
-                        f"WARNING: commit {hash} has a different references than the PR {pr}: '{subject}' vs '{issue}'"
-                    )
-                subject = issue
-
-        message = commit_type
-        if subject:
-            message += f" {subject}"
-        message += f": {commit_message}"
-        if pr != -1:
-            message += f" (#{pr})"
-
-        messages.append((PRIORITY[commit_type], int(pr), message))
-
-    for message in sorted(messages, key=lambda x: (x[0], -x[1])):
-        print(message[2])
+        # Skip everything already backported; unless this commit is the
+        # backport itself.
+        if hash not in release_commits and (pr in backported or hash in backported_commits):
+            return
+
+        for index, position in positions[hash]:
+            entry = classify_commit(hash, parsed, pr, issues, commits_seen[index])
+            if entry is not None:
+                # The position keeps the order stable, whenever things come in.
+                entries[index].append((entry[0], -entry[1], position, entry[2]))
+
+    def store_and_classify(nodes):
+        index_store(db, nodes)
+        for node in nodes:
+            number, labels, closing_issues = pr_info(node)
+            if number is not None:
+                # What GitHub told us wins over what the commit message says.
+                commit_to_pr[node["oid"]] = number
+                if "backported" in labels:
+                    backported.add(number)
+                if closing_issues:
+                    issues[number] = closing_issues
+            if node["oid"] in waiting:
+                waiting.remove(node["oid"])
+                classify(node["oid"])
+
+    with tracing.span("phase", "classify"):
+        for hash, (email, message) in commits.items():
+            if is_ignored(email, message):
+                continue
+            if hash in waiting_for:
+                waiting.add(hash)
+                continue
+            classify(hash)
+
+    try:
+        while True:
+            with tracing.span("phase", "wait for GitHub"):
+                nodes = await queue.get()
+            if nodes is None:
+                break
+            if isinstance(nodes, BaseException):
+                raise nodes
+
+            with tracing.span("phase", "store and classify fetched commits", commits=len(nodes)):
+                store_and_classify(nodes)
+    finally:
+        stop.set()
+        await producer
+
+    # Commits GitHub didn't know about.
+    with tracing.span("phase", "classify"):
+        for hash in waiting:
+            classify(hash)
+
+    return [[entry[3] for entry in sorted(range_entries)] for range_entries in entries], malformed
+
+
+def main():
+    args = parse_command_line()
+    if args.profile:
+        tracing.enable(PROFILE_FILENAME)
+
+    with tracing.span("phase", "fetch upstream"):
+        git_session.run(["fetch", "upstream"])
+        git_session.run(["checkout", "upstream/master", "-B", "changelog"])
+
+    # "git log" of a range with an unknown end just lists nothing.
+    revisions = [revision for range_ in args.ranges for revision in range_]
+    unknown = [revision for revision, oid in zip(revisions, git_session.resolve(revisions)) if oid is None]
+    if unknown:
+        print("ERROR: unknown revision %s" % ", ".join(dict.fromkeys(unknown)))
+        sys.exit(1)
+
+    # Ranges often overlap (a major release and a point release off its
+    # release branch); every commit is only resolved once.
+    commits = {}
+    ranges = []
+    with tracing.span("phase", "list commits"):
+        for base, tip in args.ranges:
+            oids = []
+            for commit in git_session.log([f"{base}..{tip}"], "%ce|%H|%s"):
+                email, hash, message = commit.split("|", 2)
+                commits[hash] = (email, message)
+                oids.append(hash)
+            ranges.append(oids)
+    oids = list(commits)
+
+    # Resolve as much as possible from the commits themselves. GitHub is only
+    # needed to find the PR of commits without "(#NNNN)", and for the issues
+    # closed by fixes.
+    subject_to_pr = {}
+    needed = set()
+    for hash, (email, message) in commits.items():
+        match = PR_SUFFIX.search(message)
+        if match:
+            subject_to_pr[hash] = int(match.group(1))
+        if not is_ignored(email, message) and (not match or message.startswith("Fix")):
+            needed.add(hash)
+    with tracing.span("phase", "find backported commits"):
+        backported_commits, release_commits = find_backported_commits([base for base, _ in args.ranges], oids)
+
+    with tracing.span("phase", "load index"):
+        db = open_index()
+        commit_to_pr, backported, issues, unindexed = index_load(db, oids)
+    missing = unindexed & needed
+
+    # Commits that are not looked up on GitHub, and not found on a release
+    # branch, still need the labels of their PR to know if it was backported.
+    unproven = {
+        subject_to_pr[hash]
+        for hash in subject_to_pr
+        if hash not in needed
+        and hash not in backported_commits
+        and hash not in release_commits
+        and not is_ignored(*commits[hash])
+    }
+    with tracing.span("phase", "load index"):
+        pr_backported, pr_issues, missing_prs = index_load_prs(db, unproven)
+    backported |= pr_backported
+    issues = {**pr_issues, **issues}
+
+    if args.refresh:
+        missing = needed
+        missing_prs = unproven
+        github_api.refresh_cache()
+    if args.offline:
+        missing = set()
+        missing_prs = set()
+
+    if (missing or missing_prs) and not BEARER_TOKEN:
+        print("Please set the GITHUB_TOKEN environment variable (or use --offline).")
+        sys.exit(1)
+
+    # What GitHub told us wins over what the commit message says.
+    commit_to_pr = {**subject_to_pr, **commit_to_pr}
+
+    if missing_prs:
+        try:
+            with tracing.span("phase", "fetch PR labels"):
+                prs = lookup_pull_requests(missing_prs)
+        except github_api.QueryError:
+            print("ERROR: couldn't fetch PRs from GitHub")
+            sys.exit(1)
+        index_store_prs(db, prs)
+        backported |= {number for number, labels, _ in prs if "backported" in labels}
+        issues.update((number, closing_issues) for number, _, closing_issues in prs if closing_issues)
+
+    fetch = []
+    waiting = missing
+    if missing and args.walk_history:
+        fetch = fetch_missing(missing, len(commits))
+        # Walking the history also brings in commits that weren't asked for;
+        # wait for those too, so they are classified with what GitHub says.
+        waiting = set(oids) if args.refresh else missing | unindexed
+    elif missing:
+        fetch = lookup_commits(missing)
+
+    try:
+        with tracing.span("phase", "build changelog"):
+            changelogs, malformed = asyncio.run(
+                build_changelog(
+                    db,
+                    commits,
+                    ranges,
+                    waiting,
+                    fetch,
+                    (commit_to_pr, backported, issues),
+                    backported_commits,
+                    release_commits,
+                )
+            )
+    except github_api.QueryError:
+        print("ERROR: couldn't fetch commits from GitHub")
+        sys.exit(1)
+
+    for hash, message in malformed:
+        print(f"WARNING: commit {hash} has a message that can't be classified: '{message}'")
+
+    for (base, tip), messages in zip(args.ranges, changelogs):
+        if len(args.ranges) > 1:
+            print(f"## {base}..{tip}")
+        for message in messages:
+            print(message)
+        if len(args.ranges) > 1:
+            print("")
+
+    github_api.print_timings()
 
 
 if __name__ == "__main__":
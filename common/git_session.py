@@ -0,0 +1,327 @@
+"""
+Shared git session used by backport.py, backport-languages.py and changelog.py.
+Copy this file next to those scripts (under .github/ of a master checkout).
+
+On a repository the size of OpenTTD, starting git (and it finding the
+repository) costs more than most of the questions the scripts ask it.
+Questions about objects (resolving revisions, reading commits, trees and
+blobs) are answered by two long-lived "git cat-file" processes. Questions
+about many commits at once are asked with a single "git log --stdin".
+
+Only commands that change something (a fetch, a checkout, writing objects,
+...) start a git process of their own, via run(), or via feed() when their
+input is better written while git runs than built up front.
+
+When profiling is enabled (see tracing.py), every git command and every
+object read is recorded there.
+"""
+
+import collections
+import contextlib
+import subprocess
+import sys
+import threading
+import time
+
+import tracing
+
+# How many revisions to write to "git cat-file --batch-check" before reading
+# the answers; this keeps both pipes from filling up.
+RESOLVE_BATCH_SIZE = 500
+
+# A commit as read from its object. "parents" is a list of hashes; "author"
+# and "committer" are a Person.
+Commit = collections.namedtuple("Commit", "oid tree parents author committer message")
+# The date is in git's "raw" format: "<seconds since epoch> <timezone>".
+Person = collections.namedtuple("Person", "name email date")
+# An entry of a tree object; "mode" is "40000" for a tree.
+TreeEntry = collections.namedtuple("TreeEntry", "mode name oid")
+
+
+def _parse_person(value):
+    # "Name <email> 1700000000 +0100"
+    start = value.index("<")
+    end = value.rindex(">")
+    return Person(value[:start].rstrip(), value[start + 1 : end], value[end + 2 :])
+
+
+class Feed:
+    # The input of a git command that is running (see Session.feed).
+    def __init__(self, process):
+        self.process = process
+        self.written = 0
+        self.aborted = False
+
+    def write(self, data):
+        if self.aborted:
+            return
+        self.written += len(data)
+        self.process.stdin.write(data)
+
+    def abort(self):
+        # Stop git before it has seen the end of its input; writing after
+        # this does nothing.
+        if not self.aborted:
+            self.aborted = True
+            self.process.kill()
+
+
+class Session:
+    def __init__(self):
+        self._batch = None
+        self._batch_check = None
+        # The cat-file processes handle one question at a time.
+        self._lock = threading.Lock()
+
+    def _cat_file(self, option):
+        return subprocess.Popen(["git", "cat-file", option], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, command, input=None, env=None):
+        # Run a one-off git command ("command" is without the "git").
+        start = time.monotonic()
+        res = subprocess.run(["git"] + command, capture_output=True, input=input, env=env)
+        tracing.record(
+            "git",
+            f"git {command[0]}",
+            start,
+            time.monotonic(),
+            bytes=len(input or b"") + len(res.stdout),
+            command=command,
+        )
+        return res
+
+    def stream(self, command):
+        # Yield the output of a git command line by line, while git produces it.
+        start = time.monotonic()
+        received = 0
+        process = subprocess.Popen(["git"] + command, stdout=subprocess.PIPE)
+        for line in process.stdout:
+            received += len(line)
+            yield line.decode().rstrip("\n")
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        tracing.record("git", f"git {command[0]}", start, time.monotonic(), bytes=received, command=command)
+
+    @contextlib.contextmanager
+    def feed(self, command):
+        # Run a one-off git command, writing its input (via the yielded Feed)
+        # while it runs, instead of building all of it first. Commands that
+        # read all input before acting on it (like "git apply") don't do
+        # anything if the Feed is aborted, or if the block raises.
+        # Raises subprocess.CalledProcessError if the command failed.
+        start = time.monotonic()
+        feed = Feed(subprocess.Popen(["git"] + command, stdin=subprocess.PIPE))
+        try:
+            yield feed
+        except BaseException:
+            feed.abort()
+            raise
+        finally:
+            try:
+                feed.process.stdin.close()
+            except BrokenPipeError:
+                # git is gone; its exit code tells what happened.
+                pass
+            feed.process.wait()
+        tracing.record("git", f"git {command[0]}", start, time.monotonic(), bytes=feed.written, command=command)
+        if not feed.aborted and feed.process.returncode != 0:
+            raise subprocess.CalledProcessError(feed.process.returncode, feed.process.args)
+
+    def resolve(self, revisions):
+        # Returns the object hash of every revision, or None for revisions that
+        # don't exist.
+        oids = []
+        with self._lock:
+            if self._batch_check is None:
+                self._batch_check = self._cat_file("--batch-check=%(objectname)")
+
+            for i in range(0, len(revisions), RESOLVE_BATCH_SIZE):
+                start = time.monotonic()
+                batch = revisions[i : i + RESOLVE_BATCH_SIZE]
+                self._batch_check.stdin.write("".join(f"{revision}\n" for revision in batch).encode())
+                self._batch_check.stdin.flush()
+                for _ in batch:
+                    line = self._batch_check.stdout.readline().decode().rstrip("\n")
+                    # Unknown revisions are answered with "<revision> missing".
+                    oids.append(None if " " in line else line)
+                tracing.record("git", "git cat-file --batch-check", start, time.monotonic(), revisions=len(batch))
+        return oids
+
+    def rev_parse(self, revision):
+        return self.resolve([revision])[0]
+
+    def read(self, revision):
+        # Returns (oid, content) of the object, or (None, None) if it doesn't exist.
+        with self._lock:
+            start = time.monotonic()
+            if self._batch is None:
+                self._batch = self._cat_file("--batch")
+
+            self._batch.stdin.write(revision.encode() + b"\n")
+            self._batch.stdin.flush()
+
+            header = self._batch.stdout.readline().decode().split()
+            if header[-1] in ("missing", "ambiguous"):
+                return None, None
+
+            content = self._batch.stdout.read(int(header[2]))
+            # Every object is followed by a newline.
+            self._batch.stdout.read(1)
+            tracing.record("git", "git cat-file --batch", start, time.monotonic(), bytes=len(content))
+        return header[0], content
+
+    def read_commit(self, revision):
+        # Returns the Commit, or None if it doesn't exist.
+        oid, content = self.read(f"{revision}^{{commit}}")
+        if oid is None:
+            return None
+
+        headers, _, message = content.decode().partition("\n\n")
+        tree = None
+        parents = []
+        author = committer = None
+        for line in headers.split("\n"):
+            key, _, value = line.partition(" ")
+            if key == "tree":
+                tree = value
+            elif key == "parent":
+                parents.append(value)
+            elif key == "author":
+                author = _parse_person(value)
+            elif key == "committer":
+                committer = _parse_person(value)
+        return Commit(oid, tree, parents, author, committer, message)
+
+    def read_tree(self, revision):
+        # Returns the list of TreeEntry of a tree, or None if it doesn't exist.
+        # "revision" is either a commit, or a "<commit>:<path>" of a tree.
+        if ":" not in revision:
+            revision += "^{tree}"
+        oid, content = self.read(revision)
+        if oid is None:
+            return None
+
+        # Every entry is "<mode> <name>\0" followed by the 20-byte hash.
+        entries = []
+        position = 0
+        while position < len(content):
+            end = content.index(b"\0", position)
+            mode, _, name = content[position:end].decode().partition(" ")
+            entries.append(TreeEntry(mode, name, content[end + 1 : end + 21].hex()))
+            position = end + 21
+        return entries
+
+    def log(self, arguments, format, revisions=None):
+        # Returns a record, formatted with "format", for every commit "git log"
+        # lists. If revisions are given, exactly those commits are listed, in
+        # that order.
+        command = ["log", "-z", f"--pretty=format:{format}"] + arguments
+        input = None
+        if revisions is not None:
+            command += ["--no-walk=unsorted", "--stdin"]
+            input = "\n".join(revisions).encode()
+        output = self.run(command, input=input).stdout.decode()
+        return output.split("\0") if output else []
+
+    def patch_ids(self, arguments, revisions=None):
+        # Returns a dict of commit -> patch-id for the commits "git log" lists.
+        # Like "git cherry", the diffs have the default context; without it,
+        # the same line removed in two places of a file has the same patch-id.
+        start = time.monotonic()
+        command = ["git", "log", "-p", "--no-merges", "--pretty=format:commit %H"] + arguments
+        if revisions is not None:
+            command += ["--no-walk=unsorted", "--stdin"]
+        log = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE if revisions is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+        )
+        if revisions is not None:
+            # "git log --stdin" reads all input before it writes anything.
+            log.stdin.write("\n".join(revisions).encode())
+            log.stdin.close()
+        res = subprocess.run(["git", "patch-id", "--stable"], stdin=log.stdout, capture_output=True)
+        log.stdout.close()
+        log.wait()
+
+        patch_ids = {}
+        for line in res.stdout.decode().splitlines():
+            patch_id, _, commit = line.partition(" ")
+            patch_ids[commit] = patch_id
+        tracing.record("git", "git patch-id", start, time.monotonic(), bytes=len(res.stdout), commits=len(patch_ids))
+        return patch_ids
+
+    def close(self):
+        with self._lock:
+            for process in (self._batch, self._batch_check):
+                if process is not None:
+                    process.stdin.close()
+                    process.wait()
+            self._batch = self._batch_check = None
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = Session()
+        return _session
+
+
+def run(command, input=None, env=None):
+    return get_session().run(command, input, env)
+
+
+def run_checked(command, input=None, env=None):
+    # Like run(), but shows what git complained about and raises
+    # subprocess.CalledProcessError if the command failed.
+    res = run(command, input, env)
+    if res.returncode != 0:
+        sys.stderr.write(res.stderr.decode())
+        res.check_returncode()
+    return res
+
+
+def stream(command):
+    return get_session().stream(command)
+
+
+def feed(command):
+    return get_session().feed(command)
+
+
+def resolve(revisions):
+    return get_session().resolve(revisions)
+
+
+def rev_parse(revision):
+    return get_session().rev_parse(revision)
+
+
+def read(revision):
+    return get_session().read(revision)
+
+
+def read_commit(revision):
+    return get_session().read_commit(revision)
+
+
+def read_tree(revision):
+    return get_session().read_tree(revision)
+
+
+def log(arguments, format, revisions=None):
+    return get_session().log(arguments, format, revisions)
+
+
+def patch_ids(arguments, revisions=None):
+    return get_session().patch_ids(arguments, revisions)
+
+
+def close():
+    get_session().close()
@@ -0,0 +1,479 @@
+"""
+Shared GitHub API client used by backport.py and changelog.py.
+Copy this file next to those scripts (under .github/ of a master checkout).
+
+All requests go through a small pool of keep-alive HTTPS connections, so a
+run with thousands of queries only pays for a handful of TLS handshakes.
+Request bodies above COMPRESS_THRESHOLD are sent gzip-compressed, responses
+are requested gzip-compressed and decompressed while being read.
+
+paginate() walks cursor-paginated GraphQL connections, fetching the next
+page in the background while the caller processes the current one.
+
+Responses are kept on disk (see ResponseCache), so a run shortly after
+another barely touches the rate limit. Responses with an ETag are revalidated
+with If-None-Match. GraphQL responses have none; they are only kept when the
+caller allows them to be used as-is for CACHE_MAX_AGE seconds ("reuse"), which
+is never the case for queries deciding what to backport or relabel. Requests are paced by the rate limit headers of the
+responses (see RateLimiter), and retried when they fail, instead of failing
+the run.
+
+Every request is timed; set GITHUB_API_TIMINGS=1 to print each request as it
+finishes, or call print_timings() at the end of a run for a summary. When
+profiling is enabled (see tracing.py), every request is also recorded there.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+
+import tracing
+
+BEARER_TOKEN = os.getenv("GITHUB_TOKEN")
+# Can be pointed elsewhere, like the stand-in of the benchmark.
+API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+# Request bodies smaller than this are not worth compressing.
+COMPRESS_THRESHOLD = 1024
+MAX_CONNECTIONS = 8
+USER_AGENT = "OpenTTD-scripts"
+
+# Where responses are kept between runs; an empty GITHUB_API_CACHE disables it.
+CACHE_FILENAME = os.getenv("GITHUB_API_CACHE", ".github-api-cache.sqlite")
+# How long (in seconds) a response without ETag is used without asking again,
+# for requests that allow it.
+CACHE_MAX_AGE = int(os.getenv("GITHUB_API_CACHE_MAX_AGE", "600"))
+# How often a failed request is tried again, and how long (in seconds) to
+# wait before the first retry; every next retry waits twice as long.
+MAX_RETRIES = 5
+RETRY_DELAY = 1
+# Leave this much of the rate limit for other users of the same token.
+RATE_LIMIT_RESERVE = 50
+# With less than this left, spread the requests evenly until the reset.
+RATE_LIMIT_PACE_BELOW = 500
+# Rather fail than wait longer than this (in seconds) for the rate limit to reset.
+MAX_RATE_LIMIT_WAIT = 15 * 60
+
+# A response in the cache; "fetched" is a time.time().
+CachedResponse = collections.namedtuple("CachedResponse", "etag fetched data")
+
+
+class QueryError(Exception):
+    pass
+
+
+class _CountingReader(io.RawIOBase):
+    """Wraps a response, counting the (compressed) bytes read from the wire."""
+
+    def __init__(self, response):
+        self._response = response
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._response.read(len(buffer))
+        self.count += len(data)
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class RequestTiming:
+    def __init__(self, method, path, status, elapsed, sent, received):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.elapsed = elapsed
+        self.sent = sent
+        self.received = received
+
+    def __str__(self):
+        return (
+            f"{self.method} {self.path} -> {self.status} in {self.elapsed * 1000:.0f}ms "
+            f"({self.sent} bytes sent, {self.received} bytes received)"
+        )
+
+
+class ResponseCache:
+    """Responses of earlier requests, also of earlier runs, keyed by the request."""
+
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT, fetched REAL, data TEXT)"
+            )
+            # Responses without ETag can't be used after CACHE_MAX_AGE; without
+            # this, every run would make the file grow.
+            self._db.execute("DELETE FROM responses WHERE etag IS NULL AND fetched < ?", (time.time() - CACHE_MAX_AGE,))
+
+    @staticmethod
+    def key(method, path, payload):
+        # For GraphQL, the payload is the query and its variables.
+        request = json.dumps([method, path, payload], sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT etag, fetched, data FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(row[0], row[1], json.loads(row[2]))
+
+    def store(self, key, etag, data):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, etag, fetched, data) VALUES (?, ?, ?, ?)",
+                (key, etag, time.time(), json.dumps(data)),
+            )
+
+
+class RateLimiter:
+    """
+    Paces the requests of one rate limit (GitHub has one for GraphQL, and one
+    for REST), by what the X-RateLimit-* headers of the responses say. With
+    less than RATE_LIMIT_PACE_BELOW left, requests are spread evenly until the
+    reset; with only RATE_LIMIT_RESERVE left, they wait for the reset.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.remaining = None
+        self.reset = None
+        # No request is sent before this time.time().
+        self._next = 0
+
+    def update(self, headers):
+        # "headers" with lowercase names.
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
+
+    def delay(self):
+        # Returns how long to wait before sending the next request, or None if
+        # that is longer than MAX_RATE_LIMIT_WAIT.
+        with self._lock:
+            now = time.time()
+            if self.remaining is None or self.reset <= now:
+                return 0
+
+            if self.remaining <= RATE_LIMIT_RESERVE:
+                delay = self.reset - now + 1
+            elif self.remaining < RATE_LIMIT_PACE_BELOW:
+                start = max(now, self._next)
+                self._next = start + (self.reset - now) / (self.remaining - RATE_LIMIT_RESERVE)
+                delay = start - now
+            else:
+                delay = 0
+            if delay > MAX_RATE_LIMIT_WAIT:
+                return None
+
+            # Requests still in flight have used some of it too.
+            self.remaining -= 1
+            return delay
+
+
+def _is_cacheable(method, path, payload):
+    if path == "/graphql":
+        return not payload["query"].lstrip().startswith("mutation")
+    return method == "GET"
+
+
+def _retry_delay(status, headers, data, attempt):
+    # Returns how long to wait before trying a request again, or None if it
+    # should not be tried again. "headers" with lowercase names.
+    if status is None or status >= 500:
+        return RETRY_DELAY * 2**attempt
+    if status in (403, 429):
+        # Secondary rate limits say how long to wait; for the primary one the
+        # RateLimiter waits for the reset.
+        if "retry-after" in headers:
+            return int(headers["retry-after"])
+        if headers.get("x-ratelimit-remaining") == "0":
+            return 0
+        return None
+    if status == 200 and isinstance(data, dict):
+        if any(error.get("type") == "RATE_LIMITED" for error in data.get("errors") or []):
+            return RETRY_DELAY * 2**attempt
+    return None
+
+
+class Client:
+    def __init__(
+        self, token=BEARER_TOKEN, api_url=API_URL, max_connections=MAX_CONNECTIONS, cache_filename=CACHE_FILENAME
+    ):
+        url = urllib.parse.urlsplit(api_url)
+        self._scheme = url.scheme
+        self._netloc = url.netloc
+        self._prefix = url.path.rstrip("/")
+        self._token = token
+
+        self._pool = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        # Cleared when the server turns out to not accept compressed bodies.
+        self._compress_requests = True
+
+        self.timings = []
+        self._timings_lock = threading.Lock()
+        self.verbose = bool(os.getenv("GITHUB_API_TIMINGS"))
+
+        self.cache = ResponseCache(cache_filename) if cache_filename else None
+        # Cleared to fetch everything again; responses are still stored.
+        self.use_cache = True
+        self.cache_hits = 0
+        self._limiters = {"graphql": RateLimiter(), "rest": RateLimiter()}
+
+    def _new_connection(self):
+        if self._scheme == "http":
+            return http.client.HTTPConnection(self._netloc, timeout=60)
+        return http.client.HTTPSConnection(self._netloc, timeout=60)
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _release(self, connection):
+        if connection is not None:
+            self._pool.put(connection)
+        self._slots.release()
+
+    def _headers(self, compressed, extra_headers):
+        headers = {
+            "Accept-Encoding": "gzip",
+            "User-Agent": USER_AGENT,
+            "Connection": "keep-alive",
+        }
+        if self._token:
+            headers["Authorization"] = f"bearer {self._token}"
+        if compressed:
+            headers["Content-Encoding"] = "gzip"
+        headers.update(extra_headers)
+        return headers
+
+    def _send(self, connection, method, path, body, compressed, extra_headers):
+        headers = self._headers(compressed, extra_headers)
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        connection.request(method, self._prefix + path, body=body, headers=headers)
+        response = connection.getresponse()
+
+        reader = _CountingReader(response)
+        stream = io.BufferedReader(reader)
+        if response.getheader("Content-Encoding") == "gzip":
+            stream = gzip.GzipFile(fileobj=stream)
+
+        # Decode while the body arrives; this also drains the response, which
+        # is required before the connection can be reused.
+        try:
+            data = json.load(io.TextIOWrapper(stream, encoding="utf-8"))
+        except ValueError:
+            data = None
+        response.read()
+
+        return response, data, reader.count
+
+    def request(self, method, path, payload=None, reuse=False):
+        # Returns (status, headers, data), where data is the decoded JSON body
+        # (or None). On connection failure, status is None.
+        # Answers from the cache when possible; otherwise waits for the rate
+        # limit and retries failed requests, before giving up. With "reuse", a
+        # response without ETag from the last CACHE_MAX_AGE seconds is used
+        # without asking GitHub.
+        key = None
+        cached = None
+        if self.cache is not None and _is_cacheable(method, path, payload):
+            key = ResponseCache.key(method, path, payload)
+            start = time.monotonic()
+            cached = self.cache.get(key) if self.use_cache else None
+            if reuse and cached is not None and cached.etag is None and time.time() - cached.fetched < CACHE_MAX_AGE:
+                tracing.record("github", "cache hit", start, time.monotonic())
+                with self._timings_lock:
+                    self.cache_hits += 1
+                return 200, {}, cached.data
+
+        extra_headers = {}
+        if cached is not None and cached.etag is not None:
+            extra_headers["If-None-Match"] = cached.etag
+
+        limiter = self._limiters["graphql" if path == "/graphql" else "rest"]
+        status, headers, data = None, {}, None
+        for attempt in range(MAX_RETRIES + 1):
+            delay = limiter.delay()
+            if delay is None:
+                print(f"GitHub API rate limit exhausted; it resets at {time.ctime(limiter.reset)}", file=sys.stderr)
+                break
+            time.sleep(delay)
+
+            status, headers, data = self._request(method, path, payload, extra_headers)
+            lowercase_headers = {name.lower(): value for name, value in headers.items()}
+            limiter.update(lowercase_headers)
+
+            delay = _retry_delay(status, lowercase_headers, data, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                break
+            print(f"GitHub API request failed (status {status}); trying again in {delay}s", file=sys.stderr)
+            time.sleep(delay)
+
+        if status == 304 and cached is not None:
+            with self._timings_lock:
+                self.cache_hits += 1
+            self.cache.store(key, cached.etag, cached.data)
+            return 200, headers, cached.data
+        if status == 200 and key is not None and not (isinstance(data, dict) and data.get("errors")):
+            # Without ETag, the response can only be used by requests with "reuse".
+            if reuse or "etag" in lowercase_headers:
+                self.cache.store(key, lowercase_headers.get("etag"), data)
+        return status, headers, data
+
+    def _request(self, method, path, payload, extra_headers):
+        body = None
+        compressed = False
+        if payload is not None:
+            body = json.dumps(payload).encode()
+            if self._compress_requests and len(body) >= COMPRESS_THRESHOLD:
+                body = gzip.compress(body)
+                compressed = True
+
+        start = time.monotonic()
+        connection, reused = self._acquire()
+        try:
+            try:
+                response, data, received = self._send(connection, method, path, body, compressed, extra_headers)
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection; retry once on a fresh one.
+                connection = self._new_connection()
+                response, data, received = self._send(connection, method, path, body, compressed, extra_headers)
+
+            if compressed and response.status in (400, 415):
+                # Server refused the compressed body; never try that again.
+                self._compress_requests = False
+                body = json.dumps(payload).encode()
+                compressed = False
+                response, data, received = self._send(connection, method, path, body, compressed, extra_headers)
+
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._release(None)
+            self._record(method, path, None, start, len(body or b""), 0)
+            return None, {}, None
+
+        self._release(connection)
+        self._record(method, path, response.status, start, len(body or b""), received)
+        return response.status, dict(response.getheaders()), data
+
+    def _record(self, method, path, status, start, sent, received):
+        end = time.monotonic()
+        timing = RequestTiming(method, path, status, end - start, sent, received)
+        tracing.record("github", f"{method} {path}", start, end, bytes=sent + received, status=status)
+        with self._timings_lock:
+            self.timings.append(timing)
+        if self.verbose:
+            print(f"[github] {timing}", file=sys.stderr)
+
+    def graphql(self, query, variables, reuse=False):
+        status, _, data = self.request("POST", "/graphql", {"query": query, "variables": variables}, reuse)
+        if status != 200:
+            return None
+        return data
+
+    def rest(self, method, path, payload=None):
+        status, _, data = self.request(method, path, payload)
+        if status is None or status >= 300:
+            return None
+        return data if data is not None else {}
+
+    def print_timings(self, file=sys.stderr):
+        if not self.timings:
+            if self.cache_hits:
+                print(f"GitHub API: no requests; {self.cache_hits} answered from the cache", file=file)
+            return
+        total = sum(timing.elapsed for timing in self.timings)
+        sent = sum(timing.sent for timing in self.timings)
+        received = sum(timing.received for timing in self.timings)
+        slowest = max(self.timings, key=lambda timing: timing.elapsed)
+        print(
+            f"GitHub API: {len(self.timings)} requests in {total:.1f}s "
+            f"({sent} bytes sent, {received} bytes received); slowest: {slowest}; "
+            f"{self.cache_hits} answered from the cache",
+            file=file,
+        )
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+        return _client
+
+
+def do_query(query, variables, reuse=False):
+    return get_client().graphql(query, variables, reuse)
+
+
+def do_rest(method, path, payload=None):
+    return get_client().rest(method, path, payload)
+
+
+def print_timings(file=sys.stderr):
+    get_client().print_timings(file)
+
+
+def refresh_cache():
+    # Fetch everything again, instead of using what is in the cache.
+    get_client().use_cache = False
+
+
+def paginate(query, variables, connection, cursor_variable="after", reuse=False):
+    # Yield the "data" of every page of a paginated query. "connection" is a
+    # function returning the paginated connection (the object holding
+    # "pageInfo { hasNextPage endCursor }") from the data of a page.
+    client = get_client()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(client.graphql, query, dict(variables), reuse)
+        while future is not None:
+            res = future.result()
+            if res is None or not res.get("data"):
+                raise QueryError(f"failed to fetch page (variables: {variables})")
+
+            # Request the next page before handing this one to the caller.
+            page_info = connection(res["data"])["pageInfo"]
+            future = None
+            if page_info["hasNextPage"]:
+                future = executor.submit(
+                    client.graphql, query, dict(variables, **{cursor_variable: page_info["endCursor"]}), reuse
+                )
+
+            yield res["data"]
@@ -0,0 +1,113 @@
+"""
+Shared profiling used by backport.py and changelog.py (--profile).
+Copy this file next to those scripts (under .github/ of a master checkout).
+
+When enabled, every GitHub API request (github_api.py), every git command
+(git_session.py) and every phase of a script is recorded with when it
+started, how long it took and how many bytes went in and out. At the end of
+the run the recording is written as a JSON trace in the Chrome trace-event
+format (open it in chrome://tracing or https://ui.perfetto.dev), and a
+summary table is printed.
+
+When not enabled, recording does nothing.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+_enabled = False
+_events = []
+_lock = threading.Lock()
+# All timestamps in the trace are relative to this.
+_origin = time.monotonic()
+
+
+def enable(filename):
+    # Start recording; when the script exits, the trace is written to filename
+    # and the summary is printed.
+    global _enabled
+
+    _enabled = True
+    atexit.register(_finish, filename)
+
+
+def is_enabled():
+    return _enabled
+
+
+def record(category, name, start, end, bytes=0, **args):
+    # Record something that ran from start to end (both time.monotonic()).
+    if not _enabled:
+        return
+
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": round((start - _origin) * 1000000),
+        "dur": round((end - start) * 1000000),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": dict(args, bytes=bytes),
+    }
+    with _lock:
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def span(category, name, **args):
+    # Record the time spent in the with-block.
+    if not _enabled:
+        yield
+        return
+
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(category, name, start, time.monotonic(), **args)
+
+
+def write_trace(filename):
+    with _lock:
+        events = list(_events)
+    # Name the threads, so the trace viewer shows something readable.
+    for thread in threading.enumerate():
+        events.append(
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.ident, "args": {"name": thread.name}}
+        )
+    with open(filename, "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+
+def print_summary(file=sys.stderr):
+    # Per category and name: how often, how long in total, the slowest, and
+    # the bytes transferred. Phases contain other events, so their time
+    # overlaps with those.
+    totals = {}
+    with _lock:
+        for event in _events:
+            total = totals.setdefault((event["cat"], event["name"]), [0, 0, 0, 0])
+            total[0] += 1
+            total[1] += event["dur"]
+            total[2] = max(total[2], event["dur"])
+            total[3] += event["args"]["bytes"]
+
+    print(f"{'category':<10} {'name':<40} {'count':>7} {'total (s)':>10} {'max (ms)':>10} {'bytes':>12}", file=file)
+    for (category, name), (count, duration, slowest, bytes) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(
+            f"{category:<10} {name[:40]:<40} {count:>7} "
+            f"{duration / 1000000:>10.2f} {slowest / 1000:>10.1f} {bytes:>12}",
+            file=file,
+        )
+
+
+def _finish(filename):
+    write_trace(filename)
+    print_summary()
+    print(f"Profile written to {filename}", file=sys.stderr)